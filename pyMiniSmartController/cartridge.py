@@ -0,0 +1,134 @@
+# !/usr/bin/env python
+
+"""
+Cartridge Encoding
+------------------------------------------------------------
+Compact, versioned cartridge records.  A compact record holds a console code and a rom identifier instead of the
+padded console and game names, and is resolved to a rom file on the raspberry pi.
+
+    ~1NEa94a8fe5cc
+    | | |
+    | | +-- rom identifier (ROM_ID_LEN hex digits)
+    | +---- console code (retropie.CONSOLE_CODES)
+    +------ marker and record version
+
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, TITLE AND
+NON-INFRINGEMENT. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR
+ANYONE DISTRIBUTING THE SOFTWARE BE LIABLE FOR ANY DAMAGES OR
+OTHER LIABILITY, WHETHER IN CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import os
+import hashlib
+import logging
+import retropie
+
+logger = logging.getLogger()
+
+# Compact record layout
+COMPACT_MARKER = '~'
+COMPACT_VERSION = '1'
+CONSOLE_CODE_LEN = 2
+ROM_ID_LEN = 10
+
+# Prefix identifying a rom identifier returned in place of a game name
+ROM_ID_TAG = '@'
+
+_CODE_CONSOLES = dict((code, console) for console, code in retropie.CONSOLE_CODES.items())
+
+# Rom identifiers per rom directory, keyed by directory and invalidated by its modification time
+_rom_id_cache = {}
+
+
+def rom_id(game):
+    """ Builds the stable identifier of a rom from its file name
+
+    :param game: rom file name
+    :return: rom identifier
+    """
+    if not isinstance(game, bytes):
+        game = game.encode('utf-8')
+    return hashlib.sha1(game).hexdigest()[:ROM_ID_LEN]
+
+
+def can_encode(console):
+    """ Checks if a console can be written as a compact record
+
+    :param console: name of console
+    :return: True if the console has a console code; otherwise False
+    """
+    return console.strip().lower() in retropie.CONSOLE_CODES
+
+
+def encode(console, game):
+    """ Builds a compact record
+
+    :param console: name of console
+    :param game: rom file name
+    :return: compact record
+    """
+    return COMPACT_MARKER + COMPACT_VERSION + retropie.CONSOLE_CODES[console.strip().lower()] + rom_id(game)
+
+
+def is_compact(payload):
+    """ Checks if a cartridge payload is a compact record
+
+    :param payload: cartridge payload
+    :return: True if compact; otherwise False
+    """
+    return payload.startswith(COMPACT_MARKER)
+
+
+def decode(payload):
+    """ Decodes a compact record
+
+    :param payload: compact record
+    :return: [console, tagged rom identifier]; otherwise ["", ""] if the record is not understood
+    """
+    version = payload[1:2]
+    if version != COMPACT_VERSION:
+        logger.debug('unsupported cartridge record version "%s"' % version)
+        return ["", ""]
+
+    code = payload[2:2 + CONSOLE_CODE_LEN]
+    rid = payload[2 + CONSOLE_CODE_LEN:2 + CONSOLE_CODE_LEN + ROM_ID_LEN]
+
+    if code not in _CODE_CONSOLES or len(rid) != ROM_ID_LEN:
+        logger.debug('invalid cartridge record "%s"' % payload)
+        return ["", ""]
+
+    return [_CODE_CONSOLES[code], ROM_ID_TAG + rid]
+
+
+def is_rom_id(game):
+    """ Checks if a game read from a cartridge is a tagged rom identifier
+
+    :param game: game read from cartridge
+    :return: True if rom identifier; otherwise False
+    """
+    return game.startswith(ROM_ID_TAG)
+
+
+def find_rom(rom_dir, game):
+    """ Finds the rom file matching a tagged rom identifier
+
+    :param rom_dir: rom directory of the console
+    :param game: tagged rom identifier
+    :return: rom file name; otherwise None
+    """
+    try:
+        mtime = os.stat(rom_dir).st_mtime
+    except OSError:
+        return None
+
+    cached = _rom_id_cache.get(rom_dir)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, dict((rom_id(name), name) for name in os.listdir(rom_dir)))
+        _rom_id_cache[rom_dir] = cached
+
+    return cached[1].get(game[len(ROM_ID_TAG):])
@@ -0,0 +1,290 @@
+# !/usr/bin/env python
+
+"""
+Firmware Image
+------------------------------------------------------------
+Intel HEX firmware images: parsing into a sparse memory image, digests, block level differences and matching the
+running firmware against the images bundled in the firmware directory.
+
+    python firmware_image.py image.hex             # summary of an image
+    python firmware_image.py old.hex new.hex       # blocks that differ between two images
+
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, TITLE AND
+NON-INFRINGEMENT. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR
+ANYONE DISTRIBUTING THE SOFTWARE BE LIABLE FOR ANY DAMAGES OR
+OTHER LIABILITY, WHETHER IN CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import os
+import re
+import sys
+import struct
+import bisect
+import hashlib
+import logging
+import binascii
+from clock import monotonic
+from mscexception import MSCException
+
+logger = logging.getLogger()
+
+# Record types
+DATA = 0
+END_OF_FILE = 1
+EXTENDED_SEGMENT_ADDRESS = 2
+START_SEGMENT_ADDRESS = 3
+EXTENDED_LINEAR_ADDRESS = 4
+START_LINEAR_ADDRESS = 5
+
+# Block size used for differences
+BLOCK_SIZE = 1024
+
+# Value of unprogrammed memory
+ERASED = 0xFF
+
+# Bundled image file names, e.g. minismartcontroller_v1.2.29.0_kit1b.hex
+IMAGE_NAME = re.compile(r'^minismartcontroller_v?(?P<version>\d+(?:\.\d+)*)_kit(?P<kit>\w+)\.hex$', re.IGNORECASE)
+
+
+class FirmwareImage(object):
+    """
+        Sparse memory image made of contiguous segments
+    """
+
+    def __init__(self):
+        self.segments = []  # [start address, bytearray], sorted by address and not overlapping
+        self.start_address = None
+
+    @classmethod
+    def load(cls, path):
+        """ Loads an Intel HEX file
+
+        :param path: hex file path
+        :return: FirmwareImage
+        """
+        with open(path) as f:
+            return cls.parse(f, path)
+
+    @classmethod
+    def parse(cls, lines, name='<hex>'):
+        """ Parses Intel HEX records, validating every record checksum
+
+        :param lines: iterable of record lines
+        :param name: name used in error messages
+        :return: FirmwareImage
+        """
+        image = cls()
+        base = 0
+        segment = None  # segment being appended to
+        end = None  # address following the last byte of that segment
+
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if line[0] != ':':
+                raise MSCException('%s:%d: record does not start with ":"' % (name, number))
+
+            try:
+                record = bytearray(binascii.unhexlify(line[1:]))
+            except (TypeError, ValueError):
+                raise MSCException('%s:%d: invalid hex digits' % (name, number))
+
+            if len(record) < 5 or len(record) != record[0] + 5:
+                raise MSCException('%s:%d: invalid record length' % (name, number))
+            if sum(record) & 0xFF:
+                raise MSCException('%s:%d: checksum mismatch' % (name, number))
+
+            rtype = record[3]
+            data = record[4:-1]
+
+            if rtype == DATA:
+                address = base + (record[1] << 8 | record[2])
+                if address == end:
+                    segment.extend(data)
+                else:
+                    segment = bytearray(data)
+                    image.segments.append([address, segment])
+                end = address + len(data)
+
+            elif rtype == END_OF_FILE:
+                break
+
+            elif rtype == EXTENDED_SEGMENT_ADDRESS:
+                base = (data[0] << 8 | data[1]) << 4
+
+            elif rtype == EXTENDED_LINEAR_ADDRESS:
+                base = (data[0] << 8 | data[1]) << 16
+
+            elif rtype in (START_SEGMENT_ADDRESS, START_LINEAR_ADDRESS):
+                image.start_address = struct.unpack('>I', bytes(data))[0]
+
+            else:
+                raise MSCException('%s:%d: unknown record type %d' % (name, number, rtype))
+
+        image.normalise()
+        return image
+
+    def normalise(self):
+        """ Sorts the segments and merges adjacent or overlapping segments, data later in the file taking precedence
+
+        :return:
+        """
+        # Find the address ranges first, then copy the data in file order, so later data overwrites earlier data
+        # whatever its address
+        merged = []
+        for start, data in sorted(self.segments, key=lambda segment: segment[0]):
+            if merged and start <= merged[-1][0] + len(merged[-1][1]):
+                previous = merged[-1]
+                previous[1].extend(bytearray(max(0, start + len(data) - previous[0] - len(previous[1]))))
+            else:
+                merged.append([start, bytearray(len(data))])
+
+        starts = [start for start, _ in merged]
+        for start, data in self.segments:
+            segment = merged[bisect.bisect_right(starts, start) - 1]
+            offset = start - segment[0]
+            segment[1][offset:offset + len(data)] = data
+        self.segments = merged
+
+    def size(self):
+        """ Number of programmed bytes
+
+        :return: size in bytes
+        """
+        return sum(len(data) for _, data in self.segments)
+
+    def digest(self):
+        """ SHA-1 digest of the programmed addresses and data
+
+        :return: hex digest
+        """
+        h = hashlib.sha1()
+        for start, data in self.segments:
+            h.update(struct.pack('>II', start, len(data)))
+            h.update(bytes(data))
+        return h.hexdigest()
+
+    def blocks(self, block_size=BLOCK_SIZE):
+        """ Splits the image into blocks, unprogrammed bytes reading as erased
+
+        :param block_size: block size in bytes
+        :return: dictionary of block address to block data
+        """
+        result = {}
+        for start, data in self.segments:
+            address = start
+            end = start + len(data)
+            while address < end:
+                block = address - address % block_size
+                chunk = data[address - start:min(end, block + block_size) - start]
+                if block not in result:
+                    result[block] = bytearray([ERASED]) * block_size
+                offset = address - block
+                result[block][offset:offset + len(chunk)] = chunk
+                address += len(chunk)
+        return result
+
+    def diff(self, other, block_size=BLOCK_SIZE):
+        """ Finds the blocks that differ from another image
+
+        :param other: FirmwareImage
+        :param block_size: block size in bytes
+        :return: sorted list of differing block addresses
+        """
+        mine = self.blocks(block_size)
+        theirs = other.blocks(block_size)
+        erased = bytearray([ERASED]) * block_size
+        return sorted(block for block in set(mine) | set(theirs)
+                      if mine.get(block, erased) != theirs.get(block, erased))
+
+
+def parse_version(version):
+    """ Converts a version string such as "1.2.29.3" or "v1.1" to a comparable tuple
+
+    :param version: version string
+    :return: tuple of integers; otherwise None if not a version
+    """
+    match = re.search(r'\d+(?:\.\d+)*', version)
+    if match is None:
+        return None
+    return tuple(int(part) for part in match.group(0).split('.'))
+
+
+def bundled_images(directory):
+    """ Lists the firmware images in a directory
+
+    :param directory: firmware directory
+    :return: list of (version tuple, kit, path), newest version first
+    """
+    result = []
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return result
+
+    for name in names:
+        match = IMAGE_NAME.match(name)
+        if match:
+            result.append((parse_version(match.group('version')), match.group('kit').lower(),
+                           os.path.join(directory, name)))
+
+    return sorted(result, reverse=True)
+
+
+def find_update(fw_version, hw_version, directory):
+    """ Matches the running firmware against the bundled images
+
+    :param fw_version: running firmware version
+    :param hw_version: hardware version, e.g. "1A" or "kit1b"
+    :param directory: firmware directory
+    :return: path of a newer bundled image for the kit; otherwise None
+    """
+    running = parse_version(fw_version)
+    kit = hw_version.strip().lower()
+    if kit.startswith('kit'):
+        kit = kit[3:]
+
+    for version, image_kit, path in bundled_images(directory):
+        if image_kit != kit:
+            continue
+        if running is None or version > running:
+            return path
+        return None  # newest image for the kit is not newer than the running firmware
+
+    logger.debug('no bundled firmware for hardware "%s"' % hw_version)
+    return None
+
+
+def main(argv):
+    logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] [%(levelname)-8s] %(message)s')
+
+    if len(argv) not in (2, 3):
+        sys.stderr.write('usage: %s image.hex [other.hex]\n' % argv[0])
+        return 2
+
+    images = []
+    for path in argv[1:]:
+        start = monotonic()
+        image = FirmwareImage.load(path)
+        elapsed = monotonic() - start
+        sys.stdout.write('%s: %d bytes in %d segments, sha1 %s, parsed in %.1f ms\n' %
+                         (path, image.size(), len(image.segments), image.digest(), elapsed * 1000))
+        images.append(image)
+
+    if len(images) == 2:
+        blocks = images[0].diff(images[1])
+        sys.stdout.write('%d blocks of %d bytes differ\n' % (len(blocks), BLOCK_SIZE))
+        for block in blocks:
+            sys.stdout.write('  0x%08X\n' % block)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
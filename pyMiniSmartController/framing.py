@@ -0,0 +1,176 @@
+# !/usr/bin/env python
+
+"""
+Framing
+------------------------------------------------------------
+Length prefixed frames with sequence numbers and a CRC-16 used by the framed protocol of the mini smart controller.
+
+Frame layout:
+
+    STX (0x02), payload length (uint8), sequence number (uint8), payload, CRC-16 (uint16, big endian)
+
+The CRC is CRC-16/CCITT-FALSE (polynomial 0x1021, initial value 0xFFFF) over the length, sequence number and
+payload.  Every side numbers the frames it sends, so the receiver can drop repeated frames and count lost ones.
+
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, TITLE AND
+NON-INFRINGEMENT. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR
+ANYONE DISTRIBUTING THE SOFTWARE BE LIABLE FOR ANY DAMAGES OR
+OTHER LIABILITY, WHETHER IN CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import struct
+from serial_trace import to_bytes
+from mscexception import MSCException
+
+STX = 0x02
+
+# Bytes before and after the payload
+HEADER_LEN = 3
+CRC_LEN = 2
+
+MAX_PAYLOAD = 255
+
+# Sequence numbers wrap at
+SEQ_MODULO = 256
+
+CRC_INIT = 0xFFFF
+CRC_POLY = 0x1021
+
+
+def _crc_table():
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ CRC_POLY) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+        table.append(crc)
+    return table
+
+CRC_TABLE = _crc_table()
+
+
+def crc16(data, crc=CRC_INIT):
+    """ Calculates the CRC-16/CCITT-FALSE of data
+
+    :param data: bytes or bytearray
+    :param crc: initial value, or the CRC of the preceding data
+    :return: CRC
+    """
+    for b in bytearray(data):
+        crc = ((crc << 8) & 0xFFFF) ^ CRC_TABLE[(crc >> 8) ^ b]
+    return crc
+
+
+def encode_frame(seq, payload):
+    """ Builds a frame
+
+    :param seq: sequence number
+    :param payload: payload string
+    :return: frame bytes
+    """
+    payload = bytearray(to_bytes(payload))
+    if len(payload) > MAX_PAYLOAD:
+        raise MSCException('frame payload of %d bytes is too long' % len(payload))
+
+    body = bytearray([len(payload), seq % SEQ_MODULO]) + payload
+    return bytes(bytearray([STX]) + body + struct.pack('>H', crc16(body)))
+
+
+class FrameDecoder(object):
+    """
+        Reassembles frames from received data, resynchronising on the next STX after a CRC error
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.last_seq = None
+        self.crc_errors = 0
+        self.duplicates = 0
+        self.lost = 0
+
+    def reset(self):
+        """ Drops any partial frame, e.g. after a timeout
+
+        :return:
+        """
+        del self.buffer[:]
+
+    def feed(self, data):
+        """ Adds received data
+
+        :param data: data read from the serial port
+        :return: list of payloads of the frames completed, in order
+        """
+        self.buffer.extend(bytearray(to_bytes(data)))
+        payloads = []
+
+        while True:
+            start = self.buffer.find(bytearray([STX]))
+            if start < 0:
+                del self.buffer[:]
+                break
+            del self.buffer[:start]
+
+            end = self._frame_end(0)
+            if end is None:
+                # Incomplete, unless the length is damaged: then a valid frame may already follow
+                start = self._next_frame(1)
+                if start is None:
+                    break
+                self.crc_errors += 1
+                del self.buffer[:start]
+                continue
+
+            frame = self.buffer[:end]
+            if crc16(frame[1:-CRC_LEN]) != (frame[-2] << 8 | frame[-1]):
+                self.crc_errors += 1
+                del self.buffer[:1]  # not a frame, or a damaged one; look for the next STX
+                continue
+            del self.buffer[:end]
+
+            seq = frame[2]
+            if seq == self.last_seq:
+                self.duplicates += 1
+                continue
+            if self.last_seq is not None:
+                self.lost += (seq - self.last_seq - 1) % SEQ_MODULO
+            self.last_seq = seq
+
+            payloads.append(bytes(frame[HEADER_LEN:-CRC_LEN]))
+
+        return payloads
+
+    def _frame_end(self, start):
+        """ Gets the end of the frame starting at an STX in the buffer
+
+        :param start: index of the STX
+        :return: index following the frame; None if the frame is incomplete
+        """
+        if len(self.buffer) < start + HEADER_LEN:
+            return None
+        end = start + HEADER_LEN + self.buffer[start + 1] + CRC_LEN
+        return end if len(self.buffer) >= end else None
+
+    def _next_frame(self, start):
+        """ Finds the next complete frame with a valid CRC
+
+        :param start: index to search from
+        :return: index of the frame's STX; None if there is none
+        """
+        start = self.buffer.find(bytearray([STX]), start)
+        while start >= 0:
+            end = self._frame_end(start)
+            if end is not None:
+                crc = self.buffer[end - 2] << 8 | self.buffer[end - 1]
+                if crc16(self.buffer[start + 1:end - CRC_LEN]) == crc:
+                    return start
+            start = self.buffer.find(bytearray([STX]), start + 1)
+        return None
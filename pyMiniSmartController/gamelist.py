@@ -0,0 +1,274 @@
+# !/usr/bin/env python
+
+"""
+Game List Index
+------------------------------------------------------------
+Indexes emulation station gamelist.xml metadata into a local SQLite database so that a cartridge game name can be
+resolved to a rom file without parsing the gamelists at launch time.
+
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, TITLE AND
+NON-INFRINGEMENT. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR
+ANYONE DISTRIBUTING THE SOFTWARE BE LIABLE FOR ANY DAMAGES OR
+OTHER LIABILITY, WHETHER IN CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import os
+import re
+import sqlite3
+import logging
+import retropie
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+logger = logging.getLogger()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS gamelists (
+    system    TEXT PRIMARY KEY,
+    source    TEXT NOT NULL,
+    mtime     REAL NOT NULL,
+    size      INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS games (
+    system    TEXT NOT NULL,
+    path      TEXT NOT NULL,
+    name      TEXT NOT NULL,
+    norm_name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS games_path ON games (system, path);
+CREATE INDEX IF NOT EXISTS games_name ON games (system, name);
+CREATE INDEX IF NOT EXISTS games_norm_name ON games (system, norm_name);
+"""
+
+# Anything that is not a letter or digit is ignored when matching names
+_NON_ALNUM = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def to_unicode(text):
+    """ Decode a name read from a cartridge or the command line
+
+    :param text: byte string or unicode string
+    :return: unicode string; undecodable bytes are replaced
+    """
+    if isinstance(text, bytes):
+        return text.decode('utf-8', 'replace')
+    return text
+
+
+def choose_rom(paths):
+    """ Choose between several roms with the same name, e.g. the discs of a multi-disc game.  A playlist (.m3u) is
+    preferred, otherwise the lowest path, which is normally the first disc.
+
+    :param paths: rom paths
+    :return: rom path
+    """
+    return min(paths, key=lambda path: (not path.lower().endswith('.m3u'), path))
+
+
+def normalise_name(name):
+    """ Normalise a game name for loose matching
+
+    :param name: game name or rom file name
+    :return: lower case name with punctuation and whitespace removed
+    """
+    return _NON_ALNUM.sub('', name).lower()
+
+
+def strip_extension(name):
+    """ Remove the file extension from a rom file name
+
+    :param name: rom file name
+    :return: name without extension
+    """
+    return os.path.splitext(name)[0]
+
+
+def relative_rom_path(path):
+    """ Convert a gamelist <path> entry to a path relative to the system rom directory
+
+    :param path: path as stored in gamelist.xml
+    :return: relative path
+    """
+    if path.startswith('./'):
+        return path[2:]
+    return path
+
+
+def iter_games(source):
+    """ Stream the games from a gamelist.xml without loading the whole document
+
+    :param source: gamelist.xml path
+    :return: generator of (path, name) tuples
+    """
+    context = ElementTree.iterparse(source, events=('start', 'end'))
+    _, root = next(context)
+
+    for event, elem in context:
+        if event != 'end' or elem.tag != 'game':
+            continue
+
+        path = elem.findtext('path')
+        if path:
+            path = relative_rom_path(path.strip())
+            name = (elem.findtext('name') or strip_extension(os.path.basename(path))).strip()
+            yield path, name
+
+        # Free the element and everything parsed so far
+        elem.clear()
+        root.clear()
+
+
+class GameListIndex(object):
+    """
+        SQLite backed index of emulation station gamelists
+    """
+
+    def __init__(self, database, gamelist_dirs=None):
+        """
+        :param database: path of the SQLite database file
+        :param gamelist_dirs: list of directories holding <system>/gamelist.xml, searched in order
+        """
+        if gamelist_dirs is None:
+            gamelist_dirs = retropie.GAMELIST_DIRS
+
+        self.database = database
+        self.gamelist_dirs = gamelist_dirs
+        self._db = None
+
+    def open(self):
+        """ Open (and create if needed) the index database
+
+        :return: database connection
+        """
+        if self._db is None:
+            self._db = sqlite3.connect(self.database)
+            # Write ahead logging, so lookups are never blocked by a refresh running on another connection
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def close(self):
+        """ Close the index database
+
+        :return:
+        """
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def find_gamelist(self, system):
+        """ Find the gamelist.xml emulation station uses for a system
+
+        :param system: name of system (console)
+        :return: path of gamelist.xml; otherwise None
+        """
+        for base in self.gamelist_dirs:
+            path = os.path.join(base, system, 'gamelist.xml')
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def refresh(self, system):
+        """ Re-index the gamelist of a system if it changed since it was last indexed.  The gamelist is parsed first
+        and only the games added, removed or renamed since the last refresh are written, in one short transaction.
+
+        :param system: name of system (console)
+        :return: True if the system was re-indexed; otherwise False
+        """
+        db = self.open()
+        source = self.find_gamelist(system)
+        row = db.execute('SELECT source, mtime, size FROM gamelists WHERE system = ?', (system,)).fetchone()
+
+        if source is None:
+            if row is not None:
+                logger.debug('gamelist for "%s" removed, dropping index' % system)
+                with db:
+                    db.execute('DELETE FROM games WHERE system = ?', (system,))
+                    db.execute('DELETE FROM gamelists WHERE system = ?', (system,))
+            return False
+
+        st = os.stat(source)
+        if row is not None and row[0] == source and row[1] == st.st_mtime and row[2] == st.st_size:
+            return False  # Index is up to date
+
+        logger.debug('indexing "%s" ...' % source)
+        try:
+            games = dict(iter_games(source))
+        except ElementTree.ParseError as e:
+            logger.debug('failed to parse "%s": %s' % (source, e))
+            return False
+
+        indexed = dict(db.execute('SELECT path, name FROM games WHERE system = ?', (system,)))
+        removed = [(system, path) for path in indexed if path not in games]
+        changed = [(system, path, name, normalise_name(name)) for path, name in games.items()
+                   if indexed.get(path) != name]
+
+        with db:
+            db.executemany('DELETE FROM games WHERE system = ? AND path = ?',
+                           removed + [(system, path) for _, path, _, _ in changed if path in indexed])
+            db.executemany('INSERT INTO games VALUES (?, ?, ?, ?)', changed)
+            db.execute('INSERT OR REPLACE INTO gamelists VALUES (?, ?, ?, ?)',
+                       (system, source, st.st_mtime, st.st_size))
+
+        logger.debug('indexed %d games for "%s": %d added or renamed, %d removed' %
+                     (len(games), system, len(changed), len(removed)))
+        return True
+
+    def refresh_all(self, systems):
+        """ Re-index the gamelists that changed since they were last indexed
+
+        :param systems: names of systems (consoles)
+        :return: number of systems re-indexed
+        """
+        return sum(1 for system in systems if self.refresh(system))
+
+    def lookup(self, system, game):
+        """ Look up the rom path of a game using the gamelist metadata
+
+        The game is matched, in order, by rom path, by display name, by normalised name and finally by a unique
+        normalised name prefix to cope with names truncated on the cartridge.  Games sharing a name, e.g. the discs
+        of a multi-disc game, are resolved with choose_rom().
+
+        The index is not refreshed here, so that no gamelist is parsed at launch time; see refresh_all().
+
+        :param system: name of system (console)
+        :param game: rom path or game name
+        :return: rom path relative to the system rom directory; otherwise None
+        """
+        db = self.open()
+        system = to_unicode(system)
+        game = to_unicode(game)
+        norm = normalise_name(game)
+
+        queries = [('SELECT path FROM games WHERE system = ? AND path = ?', (system, game)),
+                   ('SELECT path FROM games WHERE system = ? AND name = ?', (system, game)),
+                   ('SELECT path FROM games WHERE system = ? AND norm_name = ?', (system, norm))]
+
+        for query, params in queries:
+            paths = [row[0] for row in db.execute(query, params)]
+            if paths:
+                if len(paths) > 1:
+                    logger.debug('%d roms named "%s" in "%s" gamelist' % (len(paths), game, system))
+                return choose_rom(paths)
+
+        if not norm:
+            return None
+
+        names = db.execute('SELECT DISTINCT norm_name FROM games WHERE system = ? AND norm_name >= ? AND norm_name < ? '
+                           'LIMIT 2', (system, norm, norm + u'\uffff')).fetchall()
+        if len(names) > 1:
+            logger.debug('"%s" is ambiguous in "%s" gamelist' % (game, system))
+            return None
+        elif names:
+            return choose_rom([row[0] for row in db.execute('SELECT path FROM games WHERE system = ? AND norm_name = ?',
+                                                            (system, names[0][0]))])
+
+        return None
@@ -0,0 +1,158 @@
+# !/usr/bin/env python
+
+"""
+Link Supervisor
+------------------------------------------------------------
+Watches the serial link to the mini smart controller and reconnects when the port fails, the controller stops
+responding or the controller restarts.
+
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, TITLE AND
+NON-INFRINGEMENT. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR
+ANYONE DISTRIBUTING THE SOFTWARE BE LIABLE FOR ANY DAMAGES OR
+OTHER LIABILITY, WHETHER IN CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import time
+import logging
+from clock import monotonic
+from mini_smart_controller import DEFAULT_PORT
+from mscexception import MSCException
+
+logger = logging.getLogger()
+
+# Seconds without any received data before the controller is queried.  A silent dead link is detected after about
+# HEARTBEAT_PERIOD + MAX_MISSED_HEARTBEATS * (HEARTBEAT_TIMEOUT + TX_DELAY) seconds, i.e. 5 s.
+HEARTBEAT_PERIOD = 2.5
+
+# Seconds to wait for a heartbeat response; the version query is answered within milliseconds
+HEARTBEAT_TIMEOUT = 1
+
+# Unanswered heartbeats before the link is considered dead
+MAX_MISSED_HEARTBEATS = 2
+
+# Reconnect backoff in seconds, doubled after every failed attempt
+BACKOFF_MIN = 1
+BACKOFF_MAX = 30
+
+# Init attempts per reconnect
+INIT_RETRIES = 5
+
+
+class LinkSupervisor(object):
+    """
+        Serial link supervisor
+    """
+
+    def __init__(self, msc, port=DEFAULT_PORT, on_recovered=None):
+        """
+        :param msc: MiniSmartController
+        :param port: name of serial port
+        :param on_recovered: called without arguments after the link is restored
+        """
+        self.msc = msc
+        self.port = port
+        self.on_recovered = on_recovered
+        self.missed = 0
+        self.resync_requested = False
+        self.recoveries = 0
+        self.last_recovery_time = None  # seconds taken by the last recovery
+
+    def start(self):
+        """ Connects and runs the init handshake for the first time.  A failure is recovered like a lost link, so the
+        controller is retried with backoff instead of blocking the first handshake forever.
+
+        :return:
+        """
+        try:
+            self.msc.connect(self.port)
+            self.msc.init_msc(INIT_RETRIES)
+        except MSCException as e:
+            self.recover(str(e))
+
+    def request_resync(self):
+        """ Requests the init handshake to be repeated, e.g. after the controller restarted
+
+        :return:
+        """
+        self.resync_requested = True
+
+    def poll(self):
+        """ Periodic link check, called from the main loop
+
+        :return:
+        """
+        if self.resync_requested:
+            self.resync_requested = False
+            self.resync()
+            return
+
+        if monotonic() - self.msc.last_rx < HEARTBEAT_PERIOD:
+            self.missed = 0
+            return
+
+        if self.msc.heartbeat(HEARTBEAT_TIMEOUT):
+            self.missed = 0
+            return
+
+        self.missed += 1
+        logger.debug('heartbeat missed (%d/%d)' % (self.missed, MAX_MISSED_HEARTBEATS))
+        if self.missed >= MAX_MISSED_HEARTBEATS:
+            self.recover('controller not responding')
+
+    def resync(self):
+        """ Repeats the init handshake on the open port, reconnecting if it fails
+
+        :return:
+        """
+        logger.info('controller restarted, repeating init ...')
+        start = monotonic()
+        try:
+            self.msc.init_msc(INIT_RETRIES)
+        except MSCException as e:
+            self.recover(str(e))
+            return
+
+        self.recovered(start)
+
+    def recover(self, reason):
+        """ Reopens the serial port and repeats the connect and init handshake until it succeeds
+
+        :param reason: why the link is being recovered
+        :return:
+        """
+        logger.warning('serial link lost (%s), reconnecting ...' % reason)
+        start = monotonic()
+        delay = BACKOFF_MIN
+
+        while True:
+            self.msc.close()
+            try:
+                self.msc.connect(self.port)
+                self.msc.init_msc(INIT_RETRIES)
+                break
+            except MSCException as e:
+                logger.debug('reconnect failed: %s, retrying in %d s' % (e, delay))
+                time.sleep(delay)
+                delay = min(delay * 2, BACKOFF_MAX)
+
+        self.recovered(start)
+
+    def recovered(self, start):
+        """ Records the recovery and restores the controller state
+
+        :param start: monotonic time the recovery started
+        :return:
+        """
+        self.missed = 0
+        self.recoveries += 1
+        self.last_recovery_time = monotonic() - start
+        logger.info('serial link recovered in %.2f s (fw %s, hw %s)' %
+                    (self.last_recovery_time, self.msc.fw_version, self.msc.hw_version))
+
+        if self.on_recovered is not None:
+            self.on_recovered()
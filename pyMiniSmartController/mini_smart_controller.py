@@ -19,9 +19,17 @@ OTHER DEALINGS IN THE SOFTWARE.
 
 import serial
 import time
-import sys
 import logging
+import collections
+import cartridge
+import framing
+from clock import monotonic
+from serial_trace import RecordingPort
+from serial_trace import PROTOCOL_ASCII
+from serial_trace import PROTOCOL_FRAMED
+from firmware_image import parse_version
 from mscexception import MSCException
+from mscexception import MSCLinkError
 
 logger = logging.getLogger()
 
@@ -31,7 +39,29 @@ CR = chr(13)
 
 # Serial port baud rate
 BAUD_RATE = 19200
-TIMEOUT = None
+TIMEOUT = .1
+
+# Baud rate of the framed protocol
+FRAMED_BAUD_RATE = 115200
+
+# Oldest firmware supporting the framed protocol
+FRAMED_MIN_FW_VERSION = (1, 3)
+
+# Time to wait for a complete response in seconds.  Longer than the controller waits for the first frame after
+# switching to the framed protocol, so the controller is back on the ascii protocol when the host falls back.
+RESPONSE_TIMEOUT = 2
+
+# Delay after transmitting a command in seconds
+TX_DELAY = .1
+
+# Framed firmware version queries sent to a controller that does not answer the ascii protocol, and the seconds each
+# waits for the response; the version query is answered within milliseconds
+PROBE_RETRIES = 3
+PROBE_TIMEOUT = 1
+
+# Seconds without received data after which a partial frame is dropped.  A frame of the maximum length takes about
+# 25 ms at FRAMED_BAUD_RATE.
+FRAME_TIMEOUT = .1
 
 # Serial commands
 MSC_CMDS = {
@@ -53,6 +83,9 @@ MSC_CMDS = {
     'shutdown'        : {'id'         : 'S',  # this command is deprecated, but leaving for compatibility.  use 'power'
                          'subcommands': ['0', '1']
                          },
+    'protocol'        : {'id'         : 'X',  # X1<baud rate> switches to the framed protocol, X0 back to ascii
+                         'subcommands': ['0', '1']
+                         },
     'temperature'     : {'id'         : 'T',
                          'subcommands': []
                          },
@@ -90,6 +123,14 @@ class MiniSmartController(object):
         self._temperature = 0
         self.fw_version = ""
         self.hw_version = ""
+        self.tx_delay = TX_DELAY
+        self.recorder = None  # serial_trace.TraceRecorder; records all traffic when set
+        self.last_rx = 0  # monotonic time of the last character received
+        self.allow_framed = True  # use the framed protocol when the firmware supports it
+        self.framed = False
+        self.tx_seq = 0
+        self.decoder = framing.FrameDecoder()
+        self.rx_frames = collections.deque()  # payloads received but not read yet
     
     def transmit_get_response(self, cmd):
         """ Transmit command to mini smart controller and wait for response
@@ -97,11 +138,7 @@ class MiniSmartController(object):
         :param cmd: command string
         :return: response
         """
-        logger.debug('tx: ' + cmd)
-        self.serial_port.flush()
-        self.serial_port.flushInput()
-        self.serial_port.write(cmd + CR)
-        time.sleep(.1)
+        self.transmit(cmd)
         return self.read_response()
     
     def transmit(self, cmd):
@@ -110,37 +147,114 @@ class MiniSmartController(object):
         :param cmd: command string
         :return: response
         """
-        logger.debug('tx: ' + cmd)
-        self.serial_port.flush()
-        self.serial_port.flushInput()
-        self.serial_port.write(cmd + CR)
-        time.sleep(.1)
+        if self.framed:
+            logger.debug('tx: [%d] %s' % (self.tx_seq, cmd))
+            data = framing.encode_frame(self.tx_seq, cmd)
+            self.tx_seq = (self.tx_seq + 1) % framing.SEQ_MODULO
+            self.decoder.reset()
+            self.rx_frames.clear()
+        else:
+            logger.debug('tx: ' + cmd)
+            data = cmd + CR
+
+        try:
+            self.serial_port.flush()
+            self.serial_port.flushInput()
+            self.serial_port.write(data)
+        except (serial.SerialException, IOError, OSError) as e:
+            raise MSCLinkError('write failed: %s' % e)
+        time.sleep(self.tx_delay)
     
-    def read_response(self, timeout=.5):
+    def read_response(self, timeout=RESPONSE_TIMEOUT):
         """
         Reads response from from the mini smart controller.
 
         :param timeout: Timeout period for a response.
-        :return: The response
+        :return: The response; partial or empty if the timeout expired
         """
-        
+        if self.framed:
+            return self.read_frame(timeout)
+
         response = ""
+        deadline = monotonic() + timeout
         while True:
             try:
-                b = self.serial_port.read(1)[0]
-                if b == CR:
-                    logger.debug('rx: %s' % response)
-                    return response
-                
-                elif b == BELL:
-                    logger.debug("rx: %s" % BELL)
+                b = self.serial_port.read(1)
+            except (serial.SerialException, IOError, OSError) as e:
+                raise MSCLinkError('read failed: %s' % e)
+
+            if not b:
+                if monotonic() > deadline:
+                    logger.debug('rx: timeout "%s"' % response)
                     return response
-                else:
-                    response += b
-            
-            except:  # catch *all* exceptions
-                logger.critical("unexpected error:", sys.exc_info()[0])
+                continue
+
+            self.last_rx = monotonic()
+            b = b[0]
+            if b == CR:
+                logger.debug('rx: %s' % response)
                 return response
+
+            elif b == BELL:
+                logger.debug("rx: %s" % BELL)
+                return response
+            else:
+                response += b
+
+    def read_frame(self, timeout=RESPONSE_TIMEOUT):
+        """ Reads the payload of the next valid frame.  Damaged and repeated frames are dropped.
+
+        :param timeout: Timeout period for a response.
+        :return: The payload; empty if the timeout expired
+        """
+        deadline = monotonic() + timeout
+        while not self.rx_frames:
+            try:
+                data = self.serial_port.read(max(1, self.serial_port.inWaiting()))
+            except (serial.SerialException, IOError, OSError) as e:
+                raise MSCLinkError('read failed: %s' % e)
+
+            if not data:
+                if monotonic() > deadline:
+                    logger.debug('rx: timeout (%d crc errors, %d lost, %d repeated frames)' %
+                                 (self.decoder.crc_errors, self.decoder.lost, self.decoder.duplicates))
+                    self.decoder.reset()
+                    return ""
+                continue
+
+            self.last_rx = monotonic()
+            self.rx_frames.extend(self.decoder.feed(data))
+
+        payload = self.rx_frames.popleft()
+        logger.debug('rx: [%d] %s' % (self.decoder.last_seq, payload))
+        return payload
+
+    def read_available(self):
+        """ Reads all characters waiting in the receive buffer without blocking.  With the framed protocol the
+        payloads of the complete frames are returned, each terminated by CR like an ascii command.
+
+        :return: characters read
+        """
+        try:
+            waiting = self.serial_port.inWaiting()
+            data = self.serial_port.read(waiting) if waiting > 0 else ""
+        except (serial.SerialException, IOError, OSError) as e:
+            raise MSCLinkError('read failed: %s' % e)
+
+        if data:
+            self.last_rx = monotonic()
+
+        if not self.framed:
+            return data
+
+        if not data and self.decoder.buffer and monotonic() - self.last_rx > FRAME_TIMEOUT:
+            logger.debug('rx: dropped partial frame of %d bytes' % len(self.decoder.buffer))
+            self.decoder.reset()
+
+        self.rx_frames.extend(self.decoder.feed(data))
+        data = "".join(payload + CR for payload in self.rx_frames)
+        self.rx_frames.clear()
+        return data
     
     def connect(self, port=DEFAULT_PORT):
         """
@@ -151,23 +265,135 @@ class MiniSmartController(object):
         :return:
         """
         try:
-            self.serial_port = serial.Serial(port, BAUD_RATE, timeout=TIMEOUT)
-            self.flush()
-            
-            # Get mini smart controller information
-            self.fw_version = self.transmit_get_response(MSC_CMDS['firmware_version']['id'])[1:]
-            self.hw_version = self.transmit_get_response(MSC_CMDS['hardware_version']['id'])[1:]
-        
+            self.attach(serial.Serial(port, BAUD_RATE, timeout=TIMEOUT))
         except serial.SerialException as e:
             raise MSCException("{0} - {1}: {2}".format(port, e.errno, e.strerror))
-    
+
+    def attach(self, serial_port):
+        """ Starts talking to the mini smart controller over an open serial port, e.g. a simulated controller (see
+        msc_simulator.py).  The framed protocol is negotiated when the firmware supports it.
+
+        :param serial_port: serial port opened at BAUD_RATE
+        :return:
+        """
+        self.serial_port = serial_port
+        if self.recorder is not None:
+            self.serial_port = RecordingPort(self.serial_port, self.recorder)
+        self.framed = False
+        if self.recorder is not None:
+            self.recorder.mark(PROTOCOL_ASCII)
+        self.flush()
+
+        # Get mini smart controller information
+        self.fw_version = self.transmit_get_response(MSC_CMDS['firmware_version']['id'])[1:]
+        if not self.fw_version:
+            # the controller may still be using the framed protocol negotiated by an earlier run
+            self.fw_version = self.probe_framed()
+        self.hw_version = self.transmit_get_response(MSC_CMDS['hardware_version']['id'])[1:]
+
+        if self.allow_framed and not self.framed:
+            self.negotiate_protocol()
+
+    def probe_framed(self):
+        """ Queries the firmware version with the framed protocol, for a controller left on the framed protocol by an
+        earlier run.  The query is repeated, as a single damaged frame must not leave the host on the ascii protocol
+        while the controller is not.  If the framed protocol is not answered or not allowed, the controller is told to
+        go back to the ascii protocol and queried again.
+
+        :return: firmware version; empty if the controller does not answer
+        """
+        self.set_framed(True)
+        for _ in range(PROBE_RETRIES):
+            self.transmit(MSC_CMDS['firmware_version']['id'])
+            fw_version = self.read_response(PROBE_TIMEOUT)[1:]
+            if fw_version:
+                break
+
+        if fw_version and self.allow_framed:
+            return fw_version
+
+        self.transmit(MSC_CMDS['protocol']['id'] + MSC_CMDS['protocol']['subcommands'][0])
+        self.read_response(PROBE_TIMEOUT)
+        self.set_framed(False)
+        return self.transmit_get_response(MSC_CMDS['firmware_version']['id'])[1:]
+
+    def negotiate_protocol(self):
+        """ Switches to the framed protocol at FRAMED_BAUD_RATE when the firmware supports it.  The ascii protocol is
+        kept for older firmware, or if the controller refuses or does not answer at the new baud rate.
+
+        :return: True if the framed protocol is used; otherwise False
+        """
+        version = parse_version(self.fw_version)
+        if version is None or version < FRAMED_MIN_FW_VERSION:
+            logger.debug('fw %s does not support the framed protocol' % self.fw_version)
+            return False
+
+        command = MSC_CMDS['protocol']['id'] + MSC_CMDS['protocol']['subcommands'][1] + str(FRAMED_BAUD_RATE)
+        if self.transmit_get_response(command) != ACK:
+            logger.warning('framed protocol refused, using ascii protocol')
+            return False
+
+        self.set_framed(True)
+        if self.transmit_get_response(MSC_CMDS['firmware_version']['id'])[1:] != self.fw_version:
+            logger.warning('no framed response at %d baud, using ascii protocol' % FRAMED_BAUD_RATE)
+            self.set_framed(False)
+            return False
+
+        logger.debug('using framed protocol at %d baud' % FRAMED_BAUD_RATE)
+        return True
+
+    def set_framed(self, framed):
+        """ Switches the serial port between the framed and ascii protocol, without telling the controller
+
+        :param framed: True for the framed protocol
+        :return:
+        """
+        try:
+            self.serial_port.baudrate = FRAMED_BAUD_RATE if framed else BAUD_RATE
+        except (serial.SerialException, IOError, OSError, ValueError) as e:
+            raise MSCLinkError('baud rate change failed: %s' % e)
+
+        self.framed = framed
+        self.tx_seq = 0
+        self.decoder = framing.FrameDecoder()
+        if self.recorder is not None:
+            self.recorder.mark(PROTOCOL_FRAMED if framed else PROTOCOL_ASCII)
+        self.flush()
+
+    def close(self):
+        """ Closes the serial port, ignoring errors from a port that is already gone.  A controller using the framed
+        protocol is told to go back to the ascii protocol first.
+
+        :return:
+        """
+        if self.serial_port is None:
+            return
+
+        if self.framed:
+            try:
+                self.transmit(MSC_CMDS['protocol']['id'] + MSC_CMDS['protocol']['subcommands'][0])  # no response
+            except MSCException as e:
+                logger.debug('protocol reset failed: %s' % e)
+            self.framed = False
+
+        try:
+            self.serial_port.close()
+        except (serial.SerialException, IOError, OSError) as e:
+            logger.debug('close failed: %s' % e)
+        self.serial_port = None
+
     def flush(self):
         """ Flushes the serial port
         
         :return:
         """
-        self.serial_port.flush()
-        self.serial_port.flushInput()
+        try:
+            self.serial_port.flush()
+            self.serial_port.flushInput()
+        except (serial.SerialException, IOError, OSError) as e:
+            raise MSCLinkError('flush failed: %s' % e)
+        self.decoder.reset()
+        self.rx_frames.clear()
     
     def ack(self):
         """ Sends acknowledgement to the mini smart controller
@@ -182,7 +408,7 @@ class MiniSmartController(object):
         :return: list of commands
         """
         result = []
-        for key, value in MSC_CMDS.iteritems():
+        for key, value in MSC_CMDS.items():
             result.append(value['id'])
         
         return result
@@ -194,26 +420,41 @@ class MiniSmartController(object):
         :return: list of sub commands for command
         """
         result = []
-        for key, value in MSC_CMDS.iteritems():
+        for key, value in MSC_CMDS.items():
             if value['id'] == cmdid:
                 return value['subcommands']
         
         return result
     
-    def init_msc(self):
+    def init_msc(self, retries=None):
         """
         Send the init command to mini smart controller.
     
+        :param retries: number of attempts before giving up; retry forever if None
         :return:
         """
         
         # Critical section, init command must be ACKed before continuing.
+        attempts = 0
         while True:
             
             if self.transmit_get_response(MSC_CMDS['init']['id']) == ACK:
                 break  # ACK received
-            else:
-                time.sleep(1)  # Wait, then try sending the init command again
+
+            attempts += 1
+            if retries is not None and attempts >= retries:
+                raise MSCLinkError('init not acknowledged after %d attempts' % attempts)
+
+            time.sleep(1)  # Wait, then try sending the init command again
+
+    def heartbeat(self, timeout=RESPONSE_TIMEOUT):
+        """ Checks that the mini smart controller is responding by querying the firmware version
+
+        :param timeout: Timeout period for the response.
+        :return: True if the controller responded; otherwise False
+        """
+        self.transmit(MSC_CMDS['firmware_version']['id'])
+        return self.read_response(timeout) != ""
     
     def write_cpu_temperature(self, temperature):
         """
@@ -225,27 +466,34 @@ class MiniSmartController(object):
         self.transmit_get_response(MSC_CMDS['temperature']['id'] + str(temperature))
     
     def read_cart(self):
-        """ Reads the emulator name and game name from a NFC cartridge
+        """ Reads the emulator name and game name from a NFC cartridge.  For compact cartridges the game name is a
+        tagged rom identifier, see cartridge.is_rom_id().
 
         :return: response
         """
         
         result = self.transmit_get_response(MSC_CMDS['cartridge']['id'] + MSC_CMDS['cartridge']['subcommands'][0])
         
-        if result != 2:
+        if cartridge.is_compact(result[2:]):
+            return cartridge.decode(result[2:].rstrip())
+        elif ',' in result:
             r = result[2:].rstrip().split(',')
             return [r[0].rstrip(), r[1].rstrip()]
         else:
             return ["", ""]
     
-    def write_cart(self, emulator, game):
+    def write_cart(self, emulator, game, compact=False):
         """ Writes the emulator name and game name to a NFC cartridge
 
         :param emulator: emulator name
         :param game: game name
+        :param compact: write a compact record instead of the padded names when the emulator supports it
         :return: response
         """
-        payload = ','.join([emulator.ljust(MAX_CONSOLE_LEN), game.ljust(MAX_GAME_LEN)])
+        if compact and cartridge.can_encode(emulator):
+            payload = cartridge.encode(emulator, game)
+        else:
+            payload = ','.join([emulator.ljust(MAX_CONSOLE_LEN), game.ljust(MAX_GAME_LEN)])
         result = self.transmit_get_response(MSC_CMDS['cartridge']['id'] +
                                             MSC_CMDS['cartridge']['subcommands'][1] +
                                             payload)
@@ -267,9 +515,10 @@ class MiniSmartController(object):
         result = self.transmit_get_response(MSC_CMDS['cartridge']['id'] + MSC_CMDS['cartridge']['subcommands'][3])
         return int(result[2:])
     
-    def notifyLED(self, success):
+    def notifyLED(self, success, timeout=RESPONSE_TIMEOUT):
         """ Tells mini smart controller to indicate a success or fail
         :param success: variable indicating success or failure
+        :param timeout: Timeout period for the response; 0 to not wait for it
         :return:
         """
         command = MSC_CMDS['nofity']['id']
@@ -277,4 +526,6 @@ class MiniSmartController(object):
             command += MSC_CMDS['nofity']['subcommands'][1]
         else:
             command += MSC_CMDS['nofity']['subcommands'][0]
-        self.transmit_get_response(command)
+        self.transmit(command)
+        if timeout > 0:
+            self.read_response(timeout)
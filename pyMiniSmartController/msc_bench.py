@@ -0,0 +1,443 @@
+# !/usr/bin/env python
+
+"""
+Mini Smart Controller Benchmarks
+------------------------------------------------------------
+Host side microbenchmarks for py_msc.  The functions on the power press path run against a synthetic process table,
+a generated rom tree with gamelists and stubbed launchers, so no raspberry pi or controller is needed.
+
+    python msc_bench.py --roms 50000 --save before.json
+    python msc_bench.py --roms 50000 --compare before.json
+
+Memory is measured with tracemalloc, i.e. only under Python 3; under Python 2, the daemon's runtime, the memory
+columns stay empty and only the times are compared.  The peak is the most memory traced during a call, which grows
+with the temporary allocations.  Retained is the number of memory blocks still allocated after a call; blocks
+allocated and freed within the call are not counted.
+
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, TITLE AND
+NON-INFRINGEMENT. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR
+ANYONE DISTRIBUTING THE SOFTWARE BE LIABLE FOR ANY DAMAGES OR
+OTHER LIABILITY, WHETHER IN CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import os
+import sys
+import json
+import time
+import timeit
+import shutil
+import logging
+import argparse
+import tempfile
+import retropie
+import session
+import py_msc
+
+from xml.sax.saxutils import escape
+from gamelist import GameListIndex
+from mini_smart_controller import MiniSmartController
+from mini_smart_controller import MAX_GAME_LEN
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+logger = logging.getLogger()
+
+# Consoles the generated roms are spread over
+CONSOLES = ["nes", "snes", "megadrive", "gba", "n64", "psx"]
+
+# Background processes in the synthetic process table
+BACKGROUND_NAMES = ["systemd", "kworker/0:1", "kthreadd", "bash", "sshd", "dbus-daemon", "rsyslogd", "cron",
+                    "avahi-daemon", "dhcpcd", "getty", "python"]
+
+# Calls traced for memory allocations
+ALLOCATION_SAMPLES = 5
+
+# Relative slowdown of the fastest time reported as a regression
+REGRESSION_THRESHOLD = .10
+
+# Relative increase of the peak memory or retained blocks per call reported as a regression, and the smallest
+# increase in bytes and blocks reported
+ALLOCATION_THRESHOLD = .10
+PEAK_MIN_INCREASE = 1024
+RETAINED_MIN_INCREASE = 10
+
+
+class FakeProcess(object):
+    """
+        psutil.Process stand-in
+    """
+
+    def __init__(self, pid, name):
+        self.pid = pid
+        self._name = name
+
+    def name(self):
+        return self._name
+
+    def as_dict(self, attrs=None):
+        return {'pid': self.pid, 'name': self._name}
+
+
+class FakePsutil(object):
+    """
+        psutil stand-in serving a synthetic process table
+    """
+
+    class NoSuchProcess(Exception):
+        pass
+
+    def __init__(self, processes):
+        self.processes = processes
+
+    def process_iter(self):
+        return iter(self.processes)
+
+
+class FakePopen(object):
+    """
+        subprocess.Popen stand-in producing "ps ax -o pid= -o args=" output for the synthetic process table
+    """
+
+    output = ""
+
+    def __init__(self, args, **kwargs):
+        self.pid = 1
+        self.stdout = _Output(FakePopen.output)
+
+    def wait(self):
+        return 0
+
+
+class _Output(object):
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+    def close(self):
+        pass
+
+
+class StubSubprocess(object):
+    """
+        subprocess stand-in; launched commands are counted instead of run
+    """
+
+    PIPE = -1
+    Popen = FakePopen
+
+    def __init__(self):
+        self.calls = 0
+
+    def call(self, args, **kwargs):
+        self.calls += 1
+        return 0
+
+
+class NoSleep(object):
+    """
+        time module stand-in that skips sleeps
+    """
+
+    def sleep(self, seconds):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class FakePort(object):
+    """
+        Serial port stand-in answering the cartridge read with a fixed cartridge and everything else with OK
+    """
+
+    def __init__(self, cartridge):
+        self.cartridge = cartridge
+        self.buffer = ""
+
+    def write(self, data):
+        if data.startswith('Cr'):
+            self.buffer += 'Cr' + self.cartridge + '\r'
+        elif not data.startswith('OK'):
+            self.buffer += 'OK\r'
+        return len(data)
+
+    def read(self, size=1):
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def inWaiting(self):
+        return len(self.buffer)
+
+    def flush(self):
+        pass
+
+    def flushInput(self):
+        pass
+
+
+def build_rom_tree(base, count):
+    """ Generates rom files and gamelists spread over CONSOLES
+
+    :param base: directory to create the "roms" and "gamelists" directories in
+    :param count: number of roms
+    :return: list of (console, rom file name, display name)
+    """
+    games = []
+    for i in range(count):
+        console = CONSOLES[i % len(CONSOLES)]
+        rom = 'Game %06d (USA) (Rev %d).zip' % (i, i % 3)
+        name = 'Game %06d - The Considerably Longer Scraped Title Used By The Gamelist For Display Purposes' % i
+        games.append((console, rom, name))
+
+    for console in CONSOLES:
+        os.makedirs(os.path.join(base, 'roms', console))
+        os.makedirs(os.path.join(base, 'gamelists', console))
+
+    with_gamelist = {}
+    for console, rom, name in games:
+        open(os.path.join(base, 'roms', console, rom), 'w').close()
+        with_gamelist.setdefault(console, []).append((rom, name))
+
+    for console, entries in with_gamelist.items():
+        with open(os.path.join(base, 'gamelists', console, 'gamelist.xml'), 'w') as f:
+            f.write('<?xml version="1.0"?>\n<gameList>\n')
+            for rom, name in entries:
+                f.write('<game><path>./%s</path><name>%s</name><desc>%s</desc></game>\n' %
+                        (escape(rom), escape(name), 'x' * 200))
+            f.write('</gameList>\n')
+
+    return games
+
+
+def build_process_table(count):
+    """ Generates a process table with emulation station and retroarch running
+
+    :param count: number of processes
+    :return: list of FakeProcess
+    """
+    processes = [FakeProcess(100 + i, BACKGROUND_NAMES[i % len(BACKGROUND_NAMES)]) for i in range(count)]
+    processes.append(FakeProcess(100 + count, 'emulationstation'))
+    processes.append(FakeProcess(101 + count, 'retroarch'))
+    return processes
+
+
+def measure(func, number, repeat):
+    """ Times a function
+
+    :param func: function without arguments
+    :param number: calls per measurement
+    :param repeat: number of measurements
+    :return: dictionary with the per call min and median in seconds, and the peak memory and median number of
+             memory blocks retained by a call (None without tracemalloc)
+    """
+    func()  # warm up caches and the gamelist index
+    times = sorted(timeit.Timer(func).repeat(repeat=repeat, number=number))
+
+    peak = None
+    retained = None
+    if tracemalloc is not None:
+        ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+        peaks = []
+        blocks = []
+        for _ in range(ALLOCATION_SAMPLES):
+            tracemalloc.start()
+            func()
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot().filter_traces(ignore)
+            func()
+            after = tracemalloc.take_snapshot().filter_traces(ignore)
+            tracemalloc.stop()
+            blocks.append(sum(stat.count_diff for stat in after.compare_to(before, 'lineno') if stat.count_diff > 0))
+        peak = max(peaks)
+        retained = sorted(blocks)[len(blocks) // 2]
+
+    return {'min'     : times[0] / number,
+            'median'  : times[len(times) // 2] / number,
+            'peak'    : peak,
+            'retained': retained}
+
+
+def run(roms, procs, number, repeat):
+    """ Builds the fixtures and runs every benchmark
+
+    :param roms: number of roms
+    :param procs: number of processes
+    :param number: calls per measurement
+    :param repeat: number of measurements
+    :return: dictionary of benchmark name to results
+    """
+    base = tempfile.mkdtemp(prefix='msc_bench_')
+    try:
+        start = timeit.default_timer()
+        games = build_rom_tree(base, roms)
+        logger.debug('generated %d roms in %.2f s' % (roms, timeit.default_timer() - start))
+
+        processes = build_process_table(procs)
+        FakePopen.output = ''.join('%d /usr/bin/%s\n' % (p.pid, p.name()) for p in processes)
+
+        stub = StubSubprocess()
+        py_msc.psutil = FakePsutil(processes)
+        py_msc.subprocess = stub
+        py_msc.time = NoSleep()
+        py_msc.retroarch = lambda command: None
+        py_msc.power_down = lambda: None
+        retropie.ROM_BASE = os.path.join(base, 'roms')
+        py_msc.game_index = GameListIndex(os.path.join(base, 'gamelist.db'), [os.path.join(base, 'gamelists')])
+
+        console, rom, name = games[len(games) // 2]
+        py_msc.msc = MiniSmartController()
+        py_msc.msc.serial_port = FakePort(','.join([console, rom]))
+        py_msc.msc.tx_delay = 0
+
+        results = {}
+
+        start = timeit.default_timer()
+        for c in CONSOLES:
+            py_msc.game_index.refresh(c)
+        results['gamelist_index_build'] = {'min': timeit.default_timer() - start, 'median': None, 'peak': None,
+                                           'retained': None}
+
+        emulator_path = py_msc.get_emulator_path(console)
+        rom_path = py_msc.get_game_path(console, rom)
+
+        def start_game():
+            py_msc.game_session.state = session.ES
+            py_msc.game_session.set_cartridge(console, rom, emulator_path, rom_path)
+            py_msc.start_game()
+
+        def power_press(state):
+            def press():
+                py_msc.game_session.state = state  # every call takes the same path
+                py_msc.parse_line('P0')
+            return press
+
+        benchmarks = [
+            ('validate_cartridge[rom]',       lambda: py_msc.validate_cartridge(console, rom)),
+            ('validate_cartridge[name]',      lambda: py_msc.validate_cartridge(console, name)),
+            ('validate_cartridge[truncated]', lambda: py_msc.validate_cartridge(console, name[:MAX_GAME_LEN - 10])),
+            ('validate_cartridge[missing]',   lambda: py_msc.validate_cartridge(console, 'No Such Game.zip')),
+            ('process_exists[running]',       lambda: py_msc.process_exists('retroarch')),
+            ('process_exists[missing]',       lambda: py_msc.process_exists('kodi')),
+            ('kill_tasks',                    lambda: py_msc.kill_tasks(retropie.PROCESS_NAMES_EXTRA)),
+            ('start_game',                    start_game),
+            ('parse_line[reset]',             lambda: py_msc.parse_line('R0')),
+            ('parse_line[unknown]',           lambda: py_msc.parse_line('Z0')),
+            ('parse_line[power:launch]',      power_press(session.ES)),
+            ('parse_line[power:eject]',       power_press(session.IN_GAME)),
+        ]
+
+        py_msc.validate_cartridge(console, rom)
+        for label, func in benchmarks:
+            results[label] = measure(func, number, repeat)
+            logger.debug('%s done' % label)
+
+        return results
+
+    finally:
+        if py_msc.game_index is not None:
+            py_msc.game_index.close()
+        shutil.rmtree(base, ignore_errors=True)
+
+
+def report(results, baseline=None):
+    """ Prints the results, compared against a baseline if given
+
+    :param results: benchmark results
+    :param baseline: baseline results or None
+    :return: list of regressed benchmark names
+    """
+    regressions = []
+    sys.stdout.write('%-32s %12s %12s %10s %10s %10s %10s %10s\n' %
+                     ('benchmark', 'min us', 'median us', 'peak KiB', 'retained', 'time chg', 'peak chg', 'kept chg'))
+
+    for label in sorted(results):
+        result = results[label]
+        median = '-' if result['median'] is None else '%.1f' % (result['median'] * 1e6)
+        peak = '-' if result['peak'] is None else '%.1f' % (result['peak'] / 1024.0)
+        retained = '-' if result['retained'] is None else '%d' % result['retained']
+        time_change = ''
+        regressed = False
+
+        previous = baseline.get(label) if baseline is not None else None
+        if previous is not None and previous['min']:
+            ratio = result['min'] / previous['min'] - 1
+            time_change = '%+.1f%%' % (ratio * 100)
+            regressed = ratio > REGRESSION_THRESHOLD
+
+        peak_increase, peak_regressed = compare_memory(result, previous, 'peak', PEAK_MIN_INCREASE)
+        retained_increase, retained_regressed = compare_memory(result, previous, 'retained', RETAINED_MIN_INCREASE)
+        regressed = regressed or peak_regressed or retained_regressed
+        if regressed:
+            regressions.append(label)
+
+        sys.stdout.write('%-32s %12.1f %12s %10s %10s %10s %10s %10s%s\n' %
+                         (label, result['min'] * 1e6, median, peak, retained, time_change,
+                          '' if peak_increase is None else '%+.1f' % (peak_increase / 1024.0),
+                          '' if retained_increase is None else '%+d' % retained_increase,
+                          ' REGRESSION' if regressed else ''))
+
+    return regressions
+
+
+def compare_memory(result, previous, key, min_increase):
+    """ Compares a memory measurement against the baseline
+
+    :param result: benchmark result
+    :param previous: baseline result or None
+    :param key: 'peak' or 'retained'
+    :param min_increase: smallest increase reported as a regression
+    :return: (increase or None if not measured, True if regressed)
+    """
+    if previous is None or result[key] is None or previous.get(key) is None:
+        return None, False
+
+    increase = result[key] - previous[key]
+    return increase, increase >= min_increase and increase > previous[key] * ALLOCATION_THRESHOLD
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Host side microbenchmarks for py_msc.")
+    parser.add_argument("-r", "--roms", help="number of generated roms (default: 1000)", type=int, default=1000)
+    parser.add_argument("-p", "--procs", help="number of synthetic processes (default: 200)", type=int, default=200)
+    parser.add_argument("-n", "--number", help="calls per measurement (default: 100)", type=int, default=100)
+    parser.add_argument("--repeat", help="number of measurements (default: 5)", type=int, default=5)
+    parser.add_argument("-s", "--save", help="save the results to a JSON file")
+    parser.add_argument("-c", "--compare", help="compare against results saved with --save")
+    parser.add_argument("-v", "--verbose", help="increase output verbosity", action="store_true")
+    args = parser.parse_args()
+
+    # py_msc logs every step at DEBUG, which would dominate the timings
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format='[%(asctime)s] [%(levelname)-8s] %(message)s')
+
+    results = run(args.roms, args.procs, args.number, args.repeat)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    regressions = report(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,272 @@
+# !/usr/bin/env python
+
+"""
+Mini Smart Controller Replay
+------------------------------------------------------------
+Replays a serial trace recorded with "py_msc.py --trace" through a fake serial port into the main loop.  Host
+actions (shutdown, emulator launches, retroarch commands, ...) are stubbed so the replay is safe to run anywhere.
+Protocol switches recorded in the trace are applied to the controller, so framed traffic is replayed as frames.
+
+    python msc_replay.py msc.trace            # maximum speed
+    python msc_replay.py --realtime msc.trace # original timing
+
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, TITLE AND
+NON-INFRINGEMENT. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR
+ANYONE DISTRIBUTING THE SOFTWARE BE LIABLE FOR ANY DAMAGES OR
+OTHER LIABILITY, WHETHER IN CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import sys
+import time
+import logging
+import argparse
+import subprocess
+import serial_trace
+import framing
+import py_msc
+
+from clock import monotonic
+from mini_smart_controller import MiniSmartController
+from link_supervisor import LinkSupervisor
+
+logger = logging.getLogger()
+
+# Host actions replaced by stubs during a replay
+STUBBED_ACTIONS = ['power_down', 'reboot', 'retroarch', 'start_es', 'kill_tasks', 'process_exists']
+
+
+class ReplayPort(object):
+    """
+        Fake serial port serving the received data of a trace.  Received data is only released once everything the
+        host transmitted before it in the trace has been written, so responses follow their commands.
+    """
+
+    def __init__(self, records, realtime=False, on_protocol=None):
+        """
+        :param records: trace records
+        :param realtime: release received data at its recorded time; otherwise as soon as it is needed
+        :param on_protocol: called with True when the trace switches to the framed protocol, False for ascii
+        """
+        self.realtime = realtime
+        self.on_protocol = on_protocol
+        self.events = [[t, direction, data] for t, direction, data in reversed(records)]
+        self.buffer = ''
+        self.mismatches = 0
+        self.start = monotonic()
+
+    def exhausted(self):
+        return not self.events and not self.buffer
+
+    def _due(self, event):
+        return not self.realtime or event[0] <= monotonic() - self.start
+
+    def _switch_protocol(self):
+        """ Applies the protocol switches that are next in the trace
+
+        :return:
+        """
+        while self.events and self.events[-1][1] == serial_trace.MARK:
+            protocol = self.events.pop()[2]
+            logger.debug('protocol: %s' % protocol)
+            if self.on_protocol is not None:
+                self.on_protocol(protocol == serial_trace.PROTOCOL_FRAMED)
+
+    def _release(self, wait=False):
+        """ Moves received data that is due into the input buffer
+
+        :param wait: block until the next received data is due if nothing is buffered
+        :return:
+        """
+        self._switch_protocol()
+        while self.events and self.events[-1][1] == serial_trace.RX:
+            if self.realtime and wait and not self.buffer:
+                delay = self.events[-1][0] - (monotonic() - self.start)
+                if delay > 0:
+                    time.sleep(delay)
+            elif not self._due(self.events[-1]) or (not self.realtime and self.buffer):
+                break  # replay one recorded read at a time at maximum speed
+            self.buffer += self.events.pop()[2]
+
+    def pending_tx(self):
+        """ Checks if the trace expects a transmission the host has not made
+
+        :return: True if the next event is a due transmission; otherwise False
+        """
+        self._switch_protocol()
+        return bool(self.events) and self.events[-1][1] == serial_trace.TX and self._due(self.events[-1])
+
+    def skip_tx(self):
+        """ Drops the next expected transmission
+
+        :return: the dropped data
+        """
+        return self.events.pop()[2]
+
+    def inWaiting(self):
+        self._release()
+        return len(self.buffer)
+
+    def read(self, size=1):
+        self._release(wait=True)
+        if not self.buffer:
+            return ''  # end of trace, behaves like a read timeout
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def write(self, data):
+        if self.events and self.events[-1][1] == serial_trace.TX and self.events[-1][2].startswith(data):
+            self.events[-1][2] = self.events[-1][2][len(data):]
+            if not self.events[-1][2]:
+                self.events.pop()
+        else:
+            logger.debug('unexpected tx: %r' % data)
+            self.mismatches += 1
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def flushInput(self):
+        pass  # the trace only holds data the host actually read
+
+    def close(self):
+        pass
+
+
+class _NoSleep(object):
+    """
+        Stand-in for the time module that skips sleeps
+    """
+
+    def sleep(self, seconds):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class _StubSubprocess(object):
+    """
+        Stand-in for the subprocess module that records commands instead of running them
+    """
+
+    PIPE = subprocess.PIPE
+
+    def __init__(self, actions):
+        self.actions = actions
+
+    def call(self, args, **kwargs):
+        self.actions.append(('subprocess', args))
+        return 0
+
+
+def stub_host_actions(actions):
+    """ Replaces host actions in py_msc with stubs that record their calls
+
+    :param actions: list the calls are appended to
+    :return:
+    """
+    def make_stub(name):
+        def stub(*args):
+            actions.append((name, args))
+        return stub
+
+    for name in STUBBED_ACTIONS:
+        setattr(py_msc, name, make_stub(name))
+    py_msc.subprocess = _StubSubprocess(actions)
+
+
+def replay(records, realtime=False):
+    """ Replays trace records through the main loop
+
+    :param records: trace records
+    :param realtime: replay at the recorded timing; otherwise at maximum speed
+    :return: dictionary of replay statistics
+    """
+    port = ReplayPort(records, realtime, on_protocol=lambda framed: py_msc.msc.set_framed(framed))
+    actions = []
+    dispatch = []
+
+    stub_host_actions(actions)
+    if not realtime:
+        py_msc.time = _NoSleep()
+
+    parse_line = py_msc.parse_line
+
+    def timed_parse_line(buf):
+        t = monotonic()
+        parse_line(buf)
+        dispatch.append(monotonic() - t)
+
+    py_msc.parse_line = timed_parse_line
+    py_msc.msc = MiniSmartController()
+    py_msc.msc.serial_port = port
+    py_msc.supervisor = LinkSupervisor(py_msc.msc)
+    if not realtime:
+        py_msc.msc.tx_delay = 0
+
+    injected = 0
+    start = monotonic()
+    try:
+        while not port.exhausted():
+            py_msc.task_serial()
+            if port.pending_tx():
+                # Traffic the host starts on its own, e.g. the handshake and temperature updates
+                skipped = port.skip_tx()
+                logger.debug('injecting tx: %r' % skipped)
+                if py_msc.msc.framed:
+                    # keep numbering frames where the skipped transmission left off
+                    decoder = framing.FrameDecoder()
+                    decoder.feed(skipped)
+                    if decoder.last_seq is not None:
+                        py_msc.msc.tx_seq = (decoder.last_seq + 1) % framing.SEQ_MODULO
+                py_msc.msc.read_response()
+                injected += 1
+            if realtime:
+                time.sleep(py_msc.SLEEP_PERIOD)
+    finally:
+        py_msc.parse_line = parse_line
+
+    return {'elapsed'  : monotonic() - start,
+            'commands' : len(dispatch),
+            'dispatch' : sum(dispatch),
+            'injected' : injected,
+            'actions'  : actions,
+            'mismatch' : port.mismatches}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays a mini smart controller serial trace.")
+    parser.add_argument("trace", help="trace file recorded with py_msc.py --trace")
+    parser.add_argument("-r", "--realtime", help="replay at the recorded timing", action="store_true")
+    parser.add_argument("-v", "--verbose", help="increase output verbosity", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format='[%(asctime)s] [%(levelname)-8s] %(message)s')
+
+    wall_start, records = serial_trace.load(args.trace)
+    logger.debug('loaded %d records recorded at %s' % (len(records), time.ctime(wall_start)))
+
+    stats = replay(records, args.realtime)
+
+    for name, params in stats['actions']:
+        sys.stdout.write('action   : %s%r\n' % (name, params))
+    sys.stdout.write('records  : %d\n' % len(records))
+    sys.stdout.write('commands : %d\n' % stats['commands'])
+    sys.stdout.write('elapsed  : %.6f s\n' % stats['elapsed'])
+    if stats['commands']:
+        sys.stdout.write('dispatch : %.1f us/command\n' % (stats['dispatch'] * 1e6 / stats['commands']))
+    sys.stdout.write('injected : %d\n' % stats['injected'])
+    sys.stdout.write('mismatch : %d\n' % stats['mismatch'])
+
+    return 0 if stats['mismatch'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
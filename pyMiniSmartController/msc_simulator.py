@@ -0,0 +1,305 @@
+# !/usr/bin/env python
+
+"""
+Mini Smart Controller Simulator
+------------------------------------------------------------
+Simulated mini smart controller behind a fake serial port.  It speaks the ascii protocol and, for firmware that
+supports it, the framed protocol (see framing.py), including the baud rate switch.  Running it checks the protocol
+negotiation and the fallback to the ascii protocol against simulated firmware versions and links.
+
+    python msc_simulator.py       # all scenarios
+    python msc_simulator.py -v    # with the serial traffic
+
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, TITLE AND
+NON-INFRINGEMENT. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR
+ANYONE DISTRIBUTING THE SOFTWARE BE LIABLE FOR ANY DAMAGES OR
+OTHER LIABILITY, WHETHER IN CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import sys
+import time
+import logging
+import argparse
+import collections
+import framing
+
+from clock import monotonic
+from firmware_image import parse_version
+from mini_smart_controller import MiniSmartController
+from mini_smart_controller import ACK, CR, BAUD_RATE, FRAMED_BAUD_RATE, FRAMED_MIN_FW_VERSION
+
+logger = logging.getLogger()
+
+FW_VERSION = "1.3.0.0"
+HW_VERSION = "1B"
+CARTRIDGE = "snes            ,Super Mario World"
+
+# Seconds the controller waits for the first valid frame after switching to the framed protocol before it goes back
+# to the ascii protocol at BAUD_RATE.  Assumed firmware behaviour; shorter than the host's response timeout.
+CONFIRM_TIMEOUT = 1
+
+# Commands answered with an acknowledgement
+ACKED_COMMANDS = ['I', 'L', 'P', 'R', 'S', 'T']
+
+# Seconds an empty read waits, so polling the simulator does not spin
+READ_WAIT = .001
+
+# (name, simulator options, framed protocol expected)
+SCENARIOS = [
+    ('fw 1.2.29, ascii only', {'fw_version': '1.2.29.0'}, False),
+    ('fw 1.3', {}, True),
+    ('fw 1.3, link limited to 38400 baud', {'max_baud_rate': 38400}, False),
+    ('fw 1.3, every 5th frame damaged', {'corrupt_every': 5}, True),
+    ('fw 1.3, still framed from an earlier run', {'framed': True}, True),
+    ('fw 1.3, still framed, first frame damaged', {'framed': True, 'corrupt_first': 1}, True),
+    ('fw 1.3, still framed, ascii only host', {'framed': True, 'allow_framed': False}, False),
+]
+
+
+class SimulatedController(object):
+    """
+        Fake serial port with a simulated mini smart controller on the other end
+    """
+
+    def __init__(self, fw_version=FW_VERSION, hw_version=HW_VERSION, cartridge=CARTRIDGE, max_baud_rate=None,
+                 corrupt_every=0, corrupt_first=0, framed=False):
+        """
+        :param fw_version: firmware version reported
+        :param hw_version: hardware version reported
+        :param cartridge: cartridge record returned by a cartridge read
+        :param max_baud_rate: highest baud rate the link carries without errors; unlimited if None
+        :param corrupt_every: damages every nth frame sent; never if 0
+        :param corrupt_first: damages the first n frames sent
+        :param framed: start with the framed protocol, as if negotiated by an earlier run
+        """
+        self.fw_version = fw_version
+        self.hw_version = hw_version
+        self.cartridge = cartridge
+        self.max_baud_rate = max_baud_rate
+        self.corrupt_every = corrupt_every
+        self.corrupt_first = corrupt_first
+
+        self.baudrate = BAUD_RATE  # set by the host
+        self.device_baud_rate = BAUD_RATE
+        self.framed = False
+        self.line = ""
+        self.decoder = framing.FrameDecoder()
+        self.tx_seq = 0
+        self.frames_sent = 0
+        self.frames_damaged = 0
+        self.confirm_deadline = None
+        self.output = collections.deque()  # [baud rate sent at, data not read yet]
+        if framed:
+            self.switch(True, FRAMED_BAUD_RATE)
+
+    def supports_framed(self):
+        version = parse_version(self.fw_version)
+        return version is not None and version >= FRAMED_MIN_FW_VERSION
+
+    def garbled(self, sent, received):
+        """ Checks whether data arrives damaged
+
+        :param sent: baud rate of the sender
+        :param received: baud rate of the receiver
+        :return: True if the data is damaged
+        """
+        return sent != received or (self.max_baud_rate is not None and sent > self.max_baud_rate)
+
+    def switch(self, framed, baud_rate):
+        """ Switches the controller's protocol
+
+        :param framed: True for the framed protocol
+        :param baud_rate: new baud rate
+        :return:
+        """
+        logger.debug('simulator: %s protocol at %d baud' % ('framed' if framed else 'ascii', baud_rate))
+        self.framed = framed
+        self.device_baud_rate = baud_rate
+        self.line = ""
+        self.decoder = framing.FrameDecoder()
+        self.tx_seq = 0
+        self.confirm_deadline = None
+
+    def check_confirm(self):
+        if self.confirm_deadline is not None and monotonic() > self.confirm_deadline:
+            logger.debug('simulator: no frame received after switching')
+            self.switch(False, BAUD_RATE)
+
+    def send(self, response):
+        """ Sends a response or command to the host
+
+        :param response: response string
+        :return:
+        """
+        if not self.framed:
+            self.output.append([self.device_baud_rate, response + CR])
+            return
+
+        frame = bytearray(framing.encode_frame(self.tx_seq, response))
+        self.tx_seq = (self.tx_seq + 1) % framing.SEQ_MODULO
+        self.frames_sent += 1
+        if (self.frames_sent <= self.corrupt_first or
+                (self.corrupt_every and self.frames_sent % self.corrupt_every == 0)):
+            frame[-1] ^= 0xFF
+            self.frames_damaged += 1
+        self.output.append([self.device_baud_rate, bytes(frame)])
+
+    def inject(self, command):
+        """ Sends a command the controller starts on its own, e.g. "P1" for a power button press
+
+        :param command: command string
+        :return:
+        """
+        self.send(command)
+
+    def handle(self, command):
+        """ Executes a command received from the host
+
+        :param command: command string
+        :return:
+        """
+        cmdid = command[:1]
+        if command == ACK:
+            pass
+        elif cmdid == 'v':
+            self.send('v' + self.fw_version)
+        elif cmdid == 'V':
+            self.send('V' + self.hw_version)
+        elif command == 'Cr':
+            self.send('Cr' + self.cartridge)
+        elif cmdid == 'X' and self.supports_framed():
+            if command == 'X0':
+                self.send(ACK)
+                self.switch(False, BAUD_RATE)
+            elif command[1:2] == '1' and command[2:].isdigit():
+                self.send(ACK)
+                self.switch(True, int(command[2:]))
+                self.confirm_deadline = monotonic() + CONFIRM_TIMEOUT
+        elif cmdid in ACKED_COMMANDS:
+            self.send(ACK)
+        # other commands are not answered
+
+    def write(self, data):
+        self.check_confirm()
+        if self.garbled(self.baudrate, self.device_baud_rate):
+            return len(data)  # the controller only hears noise
+
+        if self.framed:
+            for payload in self.decoder.feed(data):
+                self.confirm_deadline = None
+                self.handle(payload)
+        else:
+            self.line += data
+            while CR in self.line:
+                command, self.line = self.line.split(CR, 1)
+                self.handle(command)
+        return len(data)
+
+    def read(self, size=1):
+        self.check_confirm()
+        data = ""
+        while self.output and len(data) < size:
+            chunk = self.output[0]
+            part, chunk[1] = chunk[1][:size - len(data)], chunk[1][size - len(data):]
+            if self.garbled(chunk[0], self.baudrate):
+                part = bytes(bytearray(b ^ 0x55 for b in bytearray(part)))
+            data += part
+            if not chunk[1]:
+                self.output.popleft()
+
+        if not data:
+            time.sleep(READ_WAIT)
+        return data
+
+    def inWaiting(self):
+        self.check_confirm()
+        return sum(len(chunk[1]) for chunk in self.output)
+
+    def flush(self):
+        pass
+
+    def flushInput(self):
+        self.output.clear()
+
+    def close(self):
+        pass
+
+
+def run_scenario(options, count):
+    """ Connects to a simulated controller and runs heartbeats, cartridge reads and power button presses
+
+    :param options: SimulatedController options, and allow_framed for the host
+    :param count: number of rounds
+    :return: dictionary of scenario results
+    """
+    options = dict(options)
+    msc = MiniSmartController()
+    msc.tx_delay = 0
+    msc.allow_framed = options.pop('allow_framed', True)
+    device = SimulatedController(**options)
+
+    start = monotonic()
+    msc.attach(device)
+    framed = msc.framed
+    baud_rate = device.baudrate
+    identified = msc.fw_version == device.fw_version and msc.hw_version == device.hw_version
+    connected = monotonic() - start
+    damaged = device.frames_damaged  # while connecting; these cost no check
+
+    ok = 0
+    start = monotonic()
+    for _ in range(count):
+        ok += msc.heartbeat()
+        ok += msc.read_cart() == [part.strip() for part in CARTRIDGE.split(',')]
+        device.inject('P1')
+        ok += msc.read_available() == 'P1' + CR
+    elapsed = monotonic() - start
+
+    decoder = msc.decoder
+    msc.close()
+
+    return {'framed'    : framed,
+            'baud_rate' : baud_rate,
+            'identified': identified,
+            'connect'   : connected,
+            'elapsed'   : elapsed,
+            'ok'        : ok,
+            'total'     : count * 3,
+            'crc_errors': decoder.crc_errors,
+            'lost'      : decoder.lost,
+            'damaged'   : device.frames_damaged - damaged,
+            'released'  : not device.framed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the protocol negotiation against simulated controllers.")
+    parser.add_argument("-n", "--count", help="rounds per scenario (default: %(default)d)", type=int, default=10)
+    parser.add_argument("-v", "--verbose", help="increase output verbosity", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR,
+                        format='[%(asctime)s] [%(levelname)-8s] %(message)s')
+
+    failed = 0
+    for name, options, expected in SCENARIOS:
+        result = run_scenario(options, args.count)
+        # every damaged frame costs exactly one check; anything else must succeed
+        passed = (result['framed'] == expected and result['identified'] and result['released'] and
+                  result['ok'] == result['total'] - result['damaged'])
+        failed += not passed
+        sys.stdout.write('%-42s %-6s %6d baud  connect %5.2f s  %3d/%-3d ok in %5.2f s  %d damaged  %d crc errors  '
+                         '%d lost  %s\n' %
+                         (name, 'framed' if result['framed'] else 'ascii', result['baud_rate'], result['connect'],
+                          result['ok'], result['total'], result['elapsed'], result['damaged'], result['crc_errors'],
+                          result['lost'], 'pass' if passed else 'FAIL'))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
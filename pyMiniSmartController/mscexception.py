@@ -17,4 +17,13 @@ OTHER DEALINGS IN THE SOFTWARE.
 
 class MSCException(Exception):
     def __init__(self, *args, **kwargs):
-        Exception.__init__(self, *args, **kwargs)
\ No newline at end of file
+        Exception.__init__(self, *args, **kwargs)
+
+class MSCLinkError(MSCException):
+    """ Raised when the serial link to the mini smart controller fails """
+    pass
+
+
+class MSCStateError(MSCException):
+    """ Raised when a session transition is not allowed from the current state """
+    pass
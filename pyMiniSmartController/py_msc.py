@@ -30,16 +30,35 @@ import retropie
 import psutil
 import subprocess
 import re
+import sqlite3
+import signal
+import threading
+import atexit
+import cartridge
+import session
 
 from mini_smart_controller import MiniSmartController
 from mini_smart_controller import MSC_CMDS
+from gamelist import GameListIndex
+from serial_trace import TraceRecorder
+from link_supervisor import LinkSupervisor
+from shutdown import ShutdownPipeline
+from shutdown import SHUTDOWN_BUDGET
+from thermal import ThermalHistory
+from thermal import read_cpu_temperature
+from clock import monotonic
+from firmware_image import find_update
+from mscexception import MSCLinkError
+from mscexception import MSCStateError
 
 logger = logging.getLogger()
 
 # Script directory
 SCRIPT_BASE = '/home/pi/minismartcontroller/pyMiniSmartController'
 LOG_BASE = '/var/log'
+FIRMWARE_BASE = '/home/pi/minismartcontroller/firmware'
 ROM_DETAILS = 'romdetails.txt'
+GAMELIST_INDEX = 'gamelist.db'
 
 # Script sleep period
 SLEEP_PERIOD = .1
@@ -47,9 +66,35 @@ SLEEP_PERIOD = .1
 # Mini smart controller object
 msc = None
 
+# Serial receive buffer
+rx_line = ""
+
+# Serial link supervisor
+supervisor = None
+
+# Gamelist metadata index used to resolve cartridge game names
+game_index = None
+
+# Gamelist index refresh period in seconds.  Gamelists are indexed in the background, never at launch time.
+GAMELIST_REFRESH_PERIOD = 300
+
 # Temperature sample period in seconds
 temperature_ticks = 0
-CPU_TEMPERATURE_SAMPLE_PERIOD = 60 / SLEEP_PERIOD
+CPU_TEMPERATURE_SAMPLE_PERIOD = 5 / SLEEP_PERIOD
+
+# Temperature report period in seconds.  While the temperature rises faster than CPU_TEMPERATURE_STEEP_TREND
+# (degrees C per second) the temperature projected CPU_TEMPERATURE_PROJECTION seconds ahead is reported, early if it
+# is at least CPU_TEMPERATURE_EARLY_DELTA above the last report.
+CPU_TEMPERATURE_REPORT_PERIOD = 60
+CPU_TEMPERATURE_PROJECTION = 30
+CPU_TEMPERATURE_STEEP_TREND = .05
+CPU_TEMPERATURE_EARLY_DELTA = 2
+reported_temperature = None
+reported_time = 0
+thermal_history = ThermalHistory()
+
+# Auto launch attempts at startup, see auto_launch()
+AUTO_LAUNCH_ATTEMPTS = 2
 
 # Cartridge sample period in seconds
 nfc_scan_ticks = 0
@@ -60,12 +105,16 @@ IPADDR = "127.0.0.1"
 PORTNUM = 55355
 
 # Cartridge
-valid_cartridge = False
-game_running = False
-emulator_path = ""
-rom_path = ""
-current_console = "NONE"
-current_game = "NONE"
+compact_cartridge = False
+
+# Game and emulation station session
+game_session = session.Session()
+
+# Seconds from a shutdown request until the system is halted
+shutdown_budget = SHUTDOWN_BUDGET
+
+# Serial trace file, see start_trace()
+trace_path = None
 
 def power_down():
     """ Initiate automated shutdown procedure for super-users to nicely notify users when the system is shutting
@@ -74,7 +123,32 @@ def power_down():
 
     :return:
     """
+    try:
+        game_session.transition(session.SHUTTING_DOWN)
+    except MSCStateError:
+        logger.debug('shutdown already in progress')
+        return
+
     logger.debug('performing shutdown ...')
+    pipeline = ShutdownPipeline(shutdown_budget,
+                                save_state=save_state,
+                                notify=msc.notifyLED,
+                                halt=halt)
+    pipeline.run()
+
+def save_state():
+    """ Asks retroarch to save the state of the running game
+
+    :return:
+    """
+    retroarch("SAVE_STATE")
+
+def halt():
+    """ Halts the system
+
+    :return:
+    """
+    close_controller()  # the SIGTERM sent by the shutdown may arrive too late
     subprocess.call('sudo shutdown -h now', shell=True)
 
 def reboot():
@@ -106,16 +180,19 @@ def start_es():
 
 def acquire_cpu_temperature():
     """
-    Reads the CPU temperature using "vcgencm measure_temp"
+    Reads the CPU temperature from sysfs, or using "vcgencm measure_temp" if sysfs is not available
 
     :return: CPU temperature
     """
+    temperature = read_cpu_temperature()
+    if temperature is not None:
+        return temperature
 
     # Read CPU temperature
     logger.debug('reading CPU temperature ...')
     res = os.popen('vcgencmd measure_temp').readline()
     logger.debug(res.replace('\n', ''))
-    return res.replace("temp=", "").replace("'C\n", "")
+    return float(res.replace("temp=", "").replace("'C\n", ""))
 
 def update_cpu_temperature():
     """ Handler for periodically for reading and sending the CPU temperature to the controller.
@@ -123,14 +200,32 @@ def update_cpu_temperature():
     :return:
     """
     global temperature_ticks
+    global reported_temperature
+    global reported_time
 
     if temperature_ticks > 0:
         temperature_ticks -= 1  # Still more time before sampling
         return
 
-    temperature = int(float(acquire_cpu_temperature()))  # Get the CPU temperature and convert to integer
-    msc.write_cpu_temperature(temperature)  # Send temperature to controller
     temperature_ticks = CPU_TEMPERATURE_SAMPLE_PERIOD  # Reset timer
+    temperature = acquire_cpu_temperature()
+    thermal_history.add(temperature)
+
+    now = monotonic()
+    steep = thermal_history.slope() >= CPU_TEMPERATURE_STEEP_TREND
+    if steep:
+        temperature = max(temperature, thermal_history.projected(CPU_TEMPERATURE_PROJECTION))
+    temperature = int(temperature)
+
+    if reported_temperature is not None and now - reported_time < CPU_TEMPERATURE_REPORT_PERIOD:
+        if not steep or temperature < reported_temperature + CPU_TEMPERATURE_EARLY_DELTA:
+            return  # Still more time before reporting
+        logger.debug('CPU temperature rising, reporting projected %d C early' % temperature)
+
+    msc.write_cpu_temperature(temperature)  # Send temperature to controller
+    reported_temperature = temperature
+    reported_time = now
+    logger.debug('thermal history: %s' % thermal_history.summary())
 
 def update_cartridge():
     """ Write console and rom to cartridge
@@ -145,7 +240,7 @@ def update_cartridge():
         with open(path) as f:
             results = f.readline().strip().split('/')[-2:]
             logger.debug('last played console=%s rom=%s' % (results[0], results[1]))
-            success = msc.write_cart(results[0], results[1])
+            success = msc.write_cart(results[0], results[1], compact_cartridge)
             logger.debug('cartridge update result=%d' % success)
             msc.notifyLED(success)
             time.sleep(1)
@@ -168,9 +263,10 @@ def task_scan_cartridge():
     scan_cartridge()
     nfc_scan_ticks = CARTRDIGE_SAMPLE_PERIOD
 
-def scan_cartridge():
+def scan_cartridge(state=None):
     """ Scans for a NFC cartridge
     
+    :param state: session state of the action scanning, see validate_cartridge()
     :return:
     """
 
@@ -183,29 +279,24 @@ def scan_cartridge():
     r = msc.read_cart()
     logger.debug('emulator: "%s"' % r[0])
     logger.debug('game    : "%s"' % r[1])
-    validate_cartridge(r[0], r[1])
+    validate_cartridge(r[0], r[1], state)
 
-def validate_cartridge(console, game):
+def validate_cartridge(console, game, state=None):
     """ Checks if the console and game are valid
     
     :param console: name of console
     :param game: name of game
+    :param state: only record the cartridge while the session is in this state, i.e. the state of the action that
+                  scanned it; None to record only while no action is in progress
     :return: 1 if valid; otherwise false
     """
-    global valid_cartridge
-    global emulator_path
-    global rom_path
-
-    if (is_valid_console(console) == True) and (is_valid_game(console, game) == True):
-        emulator_path = get_emulator_path(console)
-        rom_path = get_game_path(console, game)
-        valid_cartridge = True
+    game_path = is_valid_game(console, game) if is_valid_console(console) else ""
+    if game_path:
+        game_session.set_cartridge(console.strip().lower(), game, get_emulator_path(console), game_path, state)
         logger.debug('cartridge is valid')
         return True
 
-    emulator_path = ""
-    rom_path = ""
-    valid_cartridge = False
+    game_session.clear_cartridge(state)
     logger.debug('invalid or no cartridge')
     return False
 
@@ -215,16 +306,12 @@ def is_valid_console(console):
     :param console: name of console
     :return: true if valid; otherwise false
     """
-    global current_console
-
     console = console.strip().lower()  # remove leading and trailing whitespace and force to lower case
 
     if console in retropie.EMULATORS:
-        current_console = console
         logger.debug('console "%s" is valid' % console)
         return True
 
-    current_console = "NONE"
     logger.debug('could not find "%s" in supported consoles list' % console)
     return False
 
@@ -233,20 +320,55 @@ def is_valid_game(console, game):
     
     :param console: name of console
     :param game: name of game
-    :return: True if valid; otherwise False
+    :return: full path of game if valid; otherwise empty string
     """
-    global current_game
-
-    game_path = get_game_path(console, game)
+    game_path = resolve_game_path(console, game)
 
-    if os.path.isfile(game_path):
-        current_game = game
+    if game_path:
         logger.debug('found "%s"' % game_path)
-        return True
+        return game_path
 
-    current_game = "NONE"
-    logger.debug('could not find "%s"' % game_path)
-    return False
+    logger.debug('could not find "%s"' % game)
+    return ""
+
+def resolve_game_path(console, game):
+    """ Finds the rom of a game.  If the game is not a rom file name, the gamelist metadata is used to resolve
+    display names and names truncated on the cartridge.
+
+    :param console: name of console
+    :param game: rom file name, game name or rom identifier
+    :return: full path of game if found; otherwise empty string
+    """
+    if cartridge.is_rom_id(game):
+        rom = cartridge.find_rom(os.path.join(retropie.ROM_BASE, console), game)
+        if rom is None:
+            return ""
+        logger.debug('resolved rom id "%s" to "%s"' % (game, rom))
+        return get_game_path(console, rom)
+
+    path = get_game_path(console, game)
+
+    if os.path.isfile(path):
+        return path
+
+    if game_index is None:
+        return ""
+
+    try:
+        rom = game_index.lookup(console, game)
+    except (sqlite3.Error, UnicodeError) as e:
+        logger.debug('gamelist lookup failed: %s' % e)
+        return ""
+
+    if rom is not None:
+        if not isinstance(rom, str):
+            rom = rom.encode('utf-8')  # byte string paths, like the rest of the script
+        path = get_game_path(console, rom)
+        if os.path.isfile(path):
+            logger.debug('resolved "%s" to "%s"' % (game, rom))
+            return path
+
+    return ""
 
 def get_emulator_path(console):
     """ Build the full path of the emulator
@@ -274,49 +396,57 @@ def power_pressed():
     
     :return:
     """
-    global game_running
-
     logger.debug('power button pressed')
 
-    if game_running == False:
-        scan_cartridge()  # scan for cartridge first
-        game_running = start_game()
+    try:
+        if game_session.game_running == False:
+            start_game(scan=True)
 
-    else:
-        eject_game()
-        game_running = False
+        else:
+            eject_game()
 
-def start_game():
+    except MSCStateError as e:
+        logger.debug('power button ignored: %s' % e)
+
+def start_game(scan=False):
     """ Starts game detailed by game in cartridge
     
+    :param scan: scan for the cartridge first.  The scan runs once the session is launching, so an overlapping
+                 action is rejected before the cartridge is read.
     :return: True when started; otherwise false
     """
-    if valid_cartridge == True:
-        logger.debug('loading "%s" with "%s" ...' % (current_console, current_game))
+    with game_session.action(session.LAUNCHING, session.IN_GAME) as previous:
+        if scan:
+            scan_cartridge(session.LAUNCHING)
+
+        if game_session.valid_cartridge == False:
+            logger.debug('no valid cartridge inserted or detected')
+            game_session.transition(previous)
+            return False
+
+        logger.debug('loading "%s" with "%s" ...' % (game_session.console, game_session.game))
         kill_tasks(retropie.PROCESS_NAMES_EXTRA)
-        #subprocess.call('sudo openvt -c 1 -s -f %s"%s" &' % (emulator_path, rom_path), shell=True)
-        subprocess.call('%s"%s" &' % (emulator_path, rom_path), shell=True)
+        #subprocess.call('sudo openvt -c 1 -s -f %s"%s" &' % (game_session.emulator_path, game_session.rom_path), shell=True)
+        subprocess.call('%s"%s" &' % (game_session.emulator_path, game_session.rom_path), shell=True)
         subprocess.call("sudo chown pi -R /dev/shm", shell=True)  # ES needs permission as 'pi' to access this later
-        
-        return True
 
-    logger.debug('no valid cartridge inserted or detected')
-    return False
+    return True
 
 def eject_game():
     """ Exits currently running game
     
     :return:
     """
-    logger.debug('ejecting "%s" running on "%s" ...' % (current_game, current_console))
+    with game_session.action(session.EJECTING, session.ES):
+        logger.debug('ejecting "%s" running on "%s" ...' % (game_session.game, game_session.console))
 
-    if process_exists("emulationstation"):
-        logger.debug('emulationstation is running ...')
-        time.sleep(1)
+        if process_exists("emulationstation"):
+            logger.debug('emulationstation is running ...')
+            time.sleep(1)
 
-    else:
-        kill_tasks(retropie.PROCESS_NAMES)
-        start_es()
+        else:
+            kill_tasks(retropie.PROCESS_NAMES)
+            start_es()
 
 def parse_line(buf):
     """ Parses string of data for commands
@@ -329,7 +459,11 @@ def parse_line(buf):
         logger.debug('unknown command "%s" len: %d' % (buf[0], len(buf)))
         return
 
-    if buf[0] == MSC_CMDS["reset"]['id']:
+    if buf[0] == MSC_CMDS["init"]['id']:
+        # Controller restarted and is waiting for the init handshake again
+        supervisor.request_resync()
+
+    elif buf[0] == MSC_CMDS["reset"]['id']:
         subcommands = msc.get_subcommands(buf[0])
 
         if buf[1] in subcommands:
@@ -423,18 +557,135 @@ def process_exists(proc_name):
                 return True
     return False
 
+def auto_launch():
+    """ Simulates a power button press to auto launch the game if a valid cartridge is inserted.  A serial error is
+    recovered like in the main loop and the launch tried again.
+
+    :return:
+    """
+    for _ in range(AUTO_LAUNCH_ATTEMPTS):
+        try:
+            power_pressed()
+            return
+        except MSCLinkError as e:
+            supervisor.recover(str(e))
+
+    logger.warning('auto launch failed after %d attempts' % AUTO_LAUNCH_ATTEMPTS)
+
+def task_serial():
+    """ Reads pending characters from the mini smart controller and dispatches complete commands
+
+    :return:
+    """
+    global rx_line
+
+    data = msc.read_available()
+    if data:
+        rx_line += data
+        if '\r' in rx_line:
+            # full command received
+            logger.debug('rx: [main] %s' % rx_line)
+            parse_line(rx_line.strip())
+            msc.flush()
+            rx_line = ""
+
+def check_firmware():
+    """ Checks the running firmware against the bundled firmware images
+
+    :return:
+    """
+    path = find_update(msc.fw_version, msc.hw_version, FIRMWARE_BASE)
+    if path is None:
+        logger.debug('firmware %s is up to date' % msc.fw_version)
+    else:
+        logger.info('firmware update available for fw %s, hw %s: "%s"' % (msc.fw_version, msc.hw_version, path))
+
+def restore_controller_state():
+    """ Restores the controller state after the serial link was recovered.  Only the temperature is sent again:
+    the LED commands (L0/L1) are one-shot success/failure indications, not a state, and repeating one after a
+    reconnect would report an outcome that did not happen.
+
+    :return:
+    """
+    global rx_line
+    global temperature_ticks
+    global reported_temperature
+
+    rx_line = ""  # drop any partial command received before the link was lost
+    temperature_ticks = 0  # send the CPU temperature on the next loop
+    reported_temperature = None
+
+def refresh_game_index():
+    """ Keeps the gamelist index up to date, run in a background thread with its own database connection
+
+    :return:
+    """
+    index = GameListIndex(os.path.join(SCRIPT_BASE, GAMELIST_INDEX))
+    while True:
+        try:
+            index.refresh_all(retropie.EMULATORS)
+        except (sqlite3.Error, EnvironmentError) as e:
+            logger.debug('gamelist index refresh failed: %s' % e)
+        time.sleep(GAMELIST_REFRESH_PERIOD)
+
+def start_trace(path):
+    """ Records all serial traffic and saves it to a trace file on SIGUSR1 and when the controller is closed, see
+    close_controller()
+
+    :param path: trace file path
+    :return:
+    """
+    global trace_path
+    trace_path = path
+
+    msc.recorder = TraceRecorder()
+    signal.signal(signal.SIGUSR1, lambda signum, frame: save_trace())
+    logger.debug('recording serial traffic to "%s"' % path)
+
+def save_trace():
+    """ Saves the serial trace, if recording
+
+    :return:
+    """
+    if trace_path is None or msc is None or msc.recorder is None:
+        return
+
+    try:
+        msc.recorder.save(trace_path)
+    except (IOError, OSError) as e:
+        logger.warning('failed to save trace "%s": %s' % (trace_path, e))
+
+def close_controller():
+    """ Puts the controller back on the ascii protocol and closes the serial port, so that the next run finds it on
+    the ascii protocol, then saves the serial trace.  Run on exit, on SIGTERM and before halting.
+
+    :return:
+    """
+    if msc is not None:
+        msc.close()
+    save_trace()
+
+def terminated(signum, frame):
+    """ SIGTERM handler.  Closes the controller, then terminates as if not handled.
+
+    :param signum: signal number
+    :param frame: current stack frame
+    :return:
+    """
+    close_controller()
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
 def check_exit_controller():
     """
     Check if the game exited via controller.  If exited via controller, ES needs to be restarted.
     :return:
     """
-    global game_running
-
-    if game_running == True:
+    if game_session.game_running == True:
         if process_exists('retroarch') == False:
             logger.debug('detected game exit via controller ...')
             # Game was exited from controller
-            game_running = False
+            game_session.transition(session.ES)
             start_es()
 
 def main(args, log_level):
@@ -463,40 +714,55 @@ def main(args, log_level):
 
     logger.debug('pyMiniSmartController v%s ...' % __version__)
 
-    global msc
-    msc = MiniSmartController()  # Create instance of mini smart controller class
-    msc.connect()  # Connect to serial port
-    logger.debug("connected to mini smart controller fw %s, hw %s " % (msc.fw_version, msc.hw_version))
-    msc.init_msc()  # Begin initialization with mini smart controller
+    global compact_cartridge
+    compact_cartridge = args.compact
+
+    global shutdown_budget
+    shutdown_budget = args.shutdown_budget
 
-    # simulate power button pressed to auto launch if valid cartridge is inserted
-    power_pressed()
+    global game_index
+    game_index = GameListIndex(os.path.join(SCRIPT_BASE, GAMELIST_INDEX))
+    indexer = threading.Thread(target=refresh_game_index)
+    indexer.daemon = True
+    indexer.start()
 
-    if game_running:
+    global msc
+    msc = MiniSmartController()  # Create instance of mini smart controller class
+    msc.allow_framed = not args.ascii
+    atexit.register(close_controller)
+    signal.signal(signal.SIGTERM, terminated)
+    if args.trace:
+        start_trace(args.trace)
+
+    global supervisor
+    supervisor = LinkSupervisor(msc, on_recovered=restore_controller_state)
+    supervisor.start()  # Connect to serial port and begin initialization with mini smart controller
+    logger.debug("connected to mini smart controller fw %s, hw %s (%s protocol)" %
+                 (msc.fw_version, msc.hw_version, 'framed' if msc.framed else 'ascii'))
+    check_firmware()
+
+    auto_launch()
+
+    if game_session.game_running:
         logger.debug('game launched, emulation station will not be started')
     elif args.emu:
         start_es()  # Start emulation station
+        game_session.transition(session.ES)
     else:
         logger.debug('emulation station will not be started')
 
-    line = ""
-
     # Run this script F-O-R-E-V-E-R
     while True:
-        try:
-            # Serial port task
-            if msc.serial_port.inWaiting() > 0:
-                line += msc.serial_port.read(msc.serial_port.inWaiting())
-                if '\r' in line:
-                    # full command received
-                    logger.debug('rx: [main] %s' % line)
-                    parse_line(line.strip())
-                    msc.flush()
-                    line = ""
+        if game_session.state == session.SHUTTING_DOWN:
+            time.sleep(SLEEP_PERIOD)  # the controller is closed, waiting for the halt
+            continue
 
+        try:
+            task_serial()  # Serial port task
             update_cpu_temperature()  # check CPU temperature
             # task_scan_cartridge()  # check cartridge
             # check_exit_controller()
+            supervisor.poll()  # check serial link
 
             # Sleep
             time.sleep(SLEEP_PERIOD)
@@ -505,6 +771,9 @@ def main(args, log_level):
             logger.debug('keyboard interrupted')
             sys.exit(0)
 
+        except MSCLinkError as e:
+            supervisor.recover(str(e))
+
         except:  # catch *all* exceptions
             logger.critical("unexpected error:", sys.exc_info()[0])
 
@@ -528,6 +797,30 @@ if __name__ == '__main__':
         help="start emulation station",
         action="store_true")
 
+    parser.add_argument(
+        "-c",
+        "--compact",
+        help="write compact cartridges",
+        action="store_true")
+
+    parser.add_argument(
+        "-t",
+        "--trace",
+        help="record serial traffic to a trace file, saved on exit, SIGTERM or SIGUSR1")
+
+    parser.add_argument(
+        "-s",
+        "--shutdown-budget",
+        help="seconds from a shutdown request until the system is halted (default: %d)" % SHUTDOWN_BUDGET,
+        type=int,
+        default=SHUTDOWN_BUDGET)
+
+    parser.add_argument(
+        "-a",
+        "--ascii",
+        help="always use the ascii protocol, even if the firmware supports the framed protocol",
+        action="store_true")
+
     args = parser.parse_args()
 
     # Setup log
@@ -24,6 +24,17 @@ EMULATORS = ["amiga", "amstradcpc", "apple2", "arcade", "atari800", "atari2600",
              "sega32x", "segacd", "sg-1000", "snes", "vectrex", "videopac", "wonderswan", "wonderswancolor",
              "zmachine", "zxspectrum"]
 
+# Two character console codes used by compact cartridges.  Codes are written to cartridges, never change or reuse one.
+CONSOLE_CODES = {"amiga": "AM", "amstradcpc": "AC", "apple2": "A2", "arcade": "AR", "atari800": "A8",
+                 "atari2600": "A6", "atari5200": "A5", "atari7800": "A7", "atarilynx": "AL", "atarist": "AS",
+                 "c64": "C6", "coco": "CC", "dragon32": "D3", "dreamcast": "DC", "fba": "FB", "fds": "FD",
+                 "gamegear": "GG", "gb": "GB", "gba": "GA", "gbc": "GC", "intellivision": "IN", "macintosh": "MC",
+                 "mame-advmame": "MA", "mame-libretro": "ML", "mame-mame4all": "M4", "mastersystem": "MS",
+                 "megadrive": "MD", "msx": "MX", "n64": "N6", "neogeo": "NG", "nes": "NE", "ngp": "NP",
+                 "ngpc": "NC", "pc": "PC", "ports": "PO", "psp": "PP", "psx": "PS", "scummvm": "SV",
+                 "sega32x": "S3", "segacd": "SC", "sg-1000": "SG", "snes": "SN", "vectrex": "VX", "videopac": "VP",
+                 "wonderswan": "WS", "wonderswancolor": "WC", "zmachine": "ZM", "zxspectrum": "ZX"}
+
 PROCESS_NAMES = ["retroarch", "ags", "uae4all2", "uae4arm", "capricerpi", "linapple", "hatari", "stella",
                  "atari800", "xroar", "vice", "daphne", "reicast", "pifba", "osmose", "gpsp", "jzintv",
                  "basiliskll", "mame", "advmame", "dgen", "openmsx", "mupen64plus", "gngeo", "dosbox", "ppsspp",
@@ -40,3 +51,6 @@ PROCESS_NAMES_EXTRA.append("emulationstatio")
 ROM_BASE = '/home/pi/RetroPie/roms/'
 EMULATOR_BASE = "/opt/retropie/supplementary/runcommand/runcommand.sh 0 _SYS_ "
 
+# Emulation station gamelist locations, in the order emulation station searches them
+GAMELIST_DIRS = ['/home/pi/.emulationstation/gamelists',
+                 '/opt/retropie/configs/all/emulationstation/gamelists']
@@ -0,0 +1,199 @@
+# !/usr/bin/env python
+
+"""
+Serial Trace
+------------------------------------------------------------
+Records serial traffic between the raspberry pi and the mini smart controller into a bounded ring and saves it as a
+compact binary trace file for later replay (see msc_replay.py).
+
+Trace file layout (little endian):
+
+    header : magic "MSCT", version (uint8), wall clock time of the first record (double)
+    record : seconds since start (double), direction (uint8), length (uint16), data
+
+Besides the traffic, MARK records hold the protocol the host switched to ("ascii" or "framed").  A saved trace starts
+with a MARK record for the protocol in use at its first record.
+
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, TITLE AND
+NON-INFRINGEMENT. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR
+ANYONE DISTRIBUTING THE SOFTWARE BE LIABLE FOR ANY DAMAGES OR
+OTHER LIABILITY, WHETHER IN CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import time
+import struct
+import logging
+import collections
+from clock import monotonic
+from mscexception import MSCException
+
+logger = logging.getLogger()
+
+TRACE_MAGIC = b'MSCT'
+TRACE_VERSION = 2
+
+HEADER = struct.Struct('<4sBd')
+RECORD = struct.Struct('<dBH')
+
+# Directions
+TX = 0
+RX = 1
+MARK = 2  # not traffic; the host switched protocol
+
+# Protocols recorded in MARK records
+PROTOCOL_ASCII = b'ascii'
+PROTOCOL_FRAMED = b'framed'
+
+# Number of records kept in the ring
+DEFAULT_RING_SIZE = 4096
+
+# Consecutive reads closer together than this (seconds) are merged into one record
+COALESCE_WINDOW = .005
+MAX_RECORD_LEN = 1024
+
+
+def to_bytes(data):
+    """ Converts serial data to bytes
+
+    :param data: serial data
+    :return: bytes
+    """
+    if isinstance(data, bytes):
+        return data
+    return data.encode('latin-1')
+
+
+class TraceRecorder(object):
+    """
+        Bounded ring of serial traffic records
+    """
+
+    def __init__(self, size=DEFAULT_RING_SIZE):
+        """
+        :param size: maximum number of records kept; the oldest records are dropped first
+        """
+        self.records = collections.deque(maxlen=size)
+        self.start = monotonic()
+        self.wall_start = time.time()
+        self.start_protocol = PROTOCOL_ASCII  # protocol in use at the oldest record in the ring
+
+    def record(self, direction, data):
+        """ Adds serial data to the ring
+
+        :param direction: TX or RX
+        :param data: data written or read
+        :return:
+        """
+        if not data:
+            return
+
+        t = monotonic() - self.start
+
+        if self.records:
+            last = self.records[-1]
+            if last[1] == direction and t - last[0] < COALESCE_WINDOW and len(last[2]) + len(data) <= MAX_RECORD_LEN:
+                self.records[-1] = (last[0], direction, last[2] + data)
+                return
+
+        self._append((t, direction, data))
+
+    def mark(self, protocol):
+        """ Records a protocol switch of the host
+
+        :param protocol: PROTOCOL_ASCII or PROTOCOL_FRAMED
+        :return:
+        """
+        self._append((monotonic() - self.start, MARK, protocol))
+
+    def _append(self, record):
+        if len(self.records) == self.records.maxlen and self.records[0][1] == MARK:
+            self.start_protocol = self.records[0][2]  # the oldest switch is about to be dropped
+        self.records.append(record)
+
+    def save(self, path):
+        """ Saves the ring to a trace file
+
+        :param path: trace file path
+        :return: number of records saved
+        """
+        records = list(self.records)
+        if records:
+            records.insert(0, (records[0][0], MARK, self.start_protocol))
+
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(TRACE_MAGIC, TRACE_VERSION, self.wall_start))
+            for t, direction, data in records:
+                data = to_bytes(data)
+                f.write(RECORD.pack(t, direction, len(data)))
+                f.write(data)
+
+        logger.debug('saved %d trace records to "%s"' % (len(records), path))
+        return len(records)
+
+
+def load(path):
+    """ Loads a trace file
+
+    :param path: trace file path
+    :return: (wall clock start, list of (seconds since start, direction, data) records)
+    """
+    with open(path, 'rb') as f:
+        raw = f.read()
+
+    if len(raw) < HEADER.size:
+        raise MSCException('"%s" is not a trace file' % path)
+
+    magic, version, wall_start = HEADER.unpack_from(raw, 0)
+    if magic != TRACE_MAGIC:
+        raise MSCException('"%s" is not a trace file' % path)
+    if version not in (1, TRACE_VERSION):  # version 1 traces have no MARK records and are ascii only
+        raise MSCException('unsupported trace version %d' % version)
+
+    records = []
+    offset = HEADER.size
+    while offset + RECORD.size <= len(raw):
+        t, direction, length = RECORD.unpack_from(raw, offset)
+        offset += RECORD.size
+        records.append((t, direction, raw[offset:offset + length]))
+        offset += length
+
+    return wall_start, records
+
+
+class RecordingPort(object):
+    """
+        Serial port wrapper that records all traffic
+    """
+
+    def __init__(self, port, recorder):
+        """
+        :param port: serial port
+        :param recorder: TraceRecorder
+        """
+        self._port = port
+        self._recorder = recorder
+
+    def read(self, size=1):
+        data = self._port.read(size)
+        self._recorder.record(RX, data)
+        return data
+
+    def write(self, data):
+        self._recorder.record(TX, data)
+        return self._port.write(data)
+
+    @property
+    def baudrate(self):
+        return self._port.baudrate
+
+    @baudrate.setter
+    def baudrate(self, value):
+        self._port.baudrate = value
+
+    def __getattr__(self, name):
+        return getattr(self._port, name)
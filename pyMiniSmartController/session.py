@@ -0,0 +1,164 @@
+# !/usr/bin/env python
+
+"""
+Session
+------------------------------------------------------------
+Game and emulation station session state.  All state changes go through a state machine so that overlapping
+actions (e.g. a second power press while a game is launching) are rejected and the time spent in every state is
+recorded.
+
+Shutting down can be entered from every state and is never left.
+
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, TITLE AND
+NON-INFRINGEMENT. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR
+ANYONE DISTRIBUTING THE SOFTWARE BE LIABLE FOR ANY DAMAGES OR
+OTHER LIABILITY, WHETHER IN CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import logging
+import threading
+import contextlib
+import collections
+from clock import monotonic
+from mscexception import MSCStateError
+
+logger = logging.getLogger()
+
+# States
+IDLE = 'idle'
+ES = 'es'
+LAUNCHING = 'launching'
+IN_GAME = 'in-game'
+EJECTING = 'ejecting'
+SHUTTING_DOWN = 'shutting-down'
+
+# Allowed transitions from each state
+TRANSITIONS = {
+    IDLE         : (ES, LAUNCHING, SHUTTING_DOWN),
+    ES           : (IDLE, LAUNCHING, SHUTTING_DOWN),
+    LAUNCHING    : (IDLE, ES, IN_GAME, SHUTTING_DOWN),
+    IN_GAME      : (ES, EJECTING, SHUTTING_DOWN),
+    EJECTING     : (IDLE, ES, IN_GAME, SHUTTING_DOWN),
+    SHUTTING_DOWN: ()
+}
+
+# States in which an action is in progress.  Only that action may change the cartridge.
+BUSY = (LAUNCHING, EJECTING, SHUTTING_DOWN)
+
+# Number of transitions kept
+MAX_DURATIONS = 64
+
+
+class Session(object):
+    """
+        Session state
+    """
+
+    __slots__ = ('state', 'entered', 'durations', 'console', 'game', 'emulator_path', 'rom_path', 'valid_cartridge',
+                 '_lock')
+
+    def __init__(self):
+        self.state = IDLE
+        self.entered = monotonic()
+        self.durations = collections.deque(maxlen=MAX_DURATIONS)  # (from state, to state, seconds in from state)
+        self.console = "NONE"
+        self.game = "NONE"
+        self.emulator_path = ""
+        self.rom_path = ""
+        self.valid_cartridge = False
+        self._lock = threading.RLock()
+
+    @property
+    def game_running(self):
+        return self.state == IN_GAME
+
+    def transition(self, state):
+        """ Moves to a new state
+
+        :param state: new state
+        :return: previous state
+        """
+        with self._lock:
+            previous = self.state
+            if state not in TRANSITIONS[previous]:
+                raise MSCStateError('cannot go from "%s" to "%s"' % (previous, state))
+
+            now = monotonic()
+            duration = now - self.entered
+            self.durations.append((previous, state, duration))
+            self.state = state
+            self.entered = now
+
+        logger.debug('session %s -> %s (%.3f s in %s)' % (previous, state, duration, previous))
+        return previous
+
+    @contextlib.contextmanager
+    def action(self, state, done):
+        """ Runs an action in a transient state.  The session moves to the done state when the action completes, or
+        back to the previous state if it fails.
+
+        The action may end early by moving to another state itself, e.g. back to the previous state.
+
+        :param state: transient state, e.g. LAUNCHING
+        :param done: state once the action completed, e.g. IN_GAME
+        :return: previous state
+        """
+        previous = self.transition(state)
+        try:
+            yield previous
+        except:
+            with self._lock:
+                if self.state == state:
+                    self.transition(previous)
+            raise
+
+        with self._lock:
+            if self.state == state:
+                self.transition(done)
+
+    def _check_cartridge_state(self, state):
+        """ Checks that the cartridge may be changed.  Must be called with the lock held.
+
+        :param state: state of the action changing the cartridge; None if no action is in progress
+        :return:
+        """
+        if (self.state != state) if state is not None else (self.state in BUSY):
+            raise MSCStateError('cartridge cannot change while "%s"' % self.state)
+
+    def set_cartridge(self, console, game, emulator_path, rom_path, state=None):
+        """ Records a valid cartridge
+
+        :param console: name of console
+        :param game: name of game
+        :param emulator_path: full path of emulator
+        :param rom_path: full path of game
+        :param state: only record while in this state, i.e. the state of the action that scanned the cartridge;
+                      None to record only while no action is in progress
+        :return:
+        """
+        with self._lock:
+            self._check_cartridge_state(state)
+            self.console = console
+            self.game = game
+            self.emulator_path = emulator_path
+            self.rom_path = rom_path
+            self.valid_cartridge = True
+
+    def clear_cartridge(self, state=None):
+        """ Records that no valid cartridge is inserted
+
+        :param state: see set_cartridge()
+        :return:
+        """
+        with self._lock:
+            self._check_cartridge_state(state)
+            self.console = "NONE"
+            self.game = "NONE"
+            self.emulator_path = ""
+            self.rom_path = ""
+            self.valid_cartridge = False
@@ -0,0 +1,169 @@
+# !/usr/bin/env python
+
+"""
+Shutdown
+------------------------------------------------------------
+Shutdown pipeline with a hard time budget.  The running game is saved, emulators and emulation station are stopped
+in parallel, filesystems are synced and the system is halted, whether or not every stage finished in time.
+
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, TITLE AND
+NON-INFRINGEMENT. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR
+ANYONE DISTRIBUTING THE SOFTWARE BE LIABLE FOR ANY DAMAGES OR
+OTHER LIABILITY, WHETHER IN CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import time
+import logging
+import threading
+import subprocess
+import psutil
+import retropie
+from clock import monotonic
+from mscexception import MSCException
+
+logger = logging.getLogger()
+
+# Seconds from the shutdown request until the system is halted
+SHUTDOWN_BUDGET = 15
+
+# Seconds retroarch is given to write a save state
+SAVE_STATE_WAIT = 2
+
+# Seconds of the budget kept for syncing filesystems
+SYNC_RESERVE = 3
+
+# Seconds kept for killing processes that ignored SIGTERM
+KILL_RESERVE = .5
+
+# Seconds a notification takes besides waiting for the response: the transmit delay and the serial read timeout
+NOTIFY_RESERVE = .2
+
+FRONTEND_NAMES = ["emulationstation", "emulationstatio"]
+EMULATOR_NAMES = [name for name in retropie.PROCESS_NAMES if name not in FRONTEND_NAMES] + ["kodi", "kodi.bin"]
+
+
+class ShutdownPipeline(object):
+    """
+        Shutdown pipeline
+    """
+
+    def __init__(self, budget=SHUTDOWN_BUDGET, save_state=None, notify=None, halt=None):
+        """
+        :param budget: seconds until the system is halted
+        :param save_state: called without arguments to ask the emulator to save its state
+        :param notify: called with True when a stage completed in time, otherwise False, and the seconds it may wait
+                       for a response; 0 to not wait
+        :param halt: called without arguments to halt the system
+        """
+        self.budget = budget
+        self.save_state = save_state
+        self.notify = notify
+        self.halt = halt
+        self.deadline = None
+
+    def remaining(self, reserve=0):
+        """ Seconds left in the budget
+
+        :param reserve: seconds to keep back for later stages
+        :return: seconds left, never negative
+        """
+        return max(0, self.deadline - reserve - monotonic())
+
+    def run(self):
+        """ Runs the pipeline.  Always ends by halting the system.
+
+        :return:
+        """
+        start = monotonic()
+        self.deadline = start + self.budget
+        logger.debug('shutting down within %d s ...' % self.budget)
+
+        try:
+            stages = [threading.Thread(target=self.stop_emulators),
+                      threading.Thread(target=self.terminate, args=(FRONTEND_NAMES, SYNC_RESERVE))]
+            for stage in stages:
+                stage.daemon = True
+                stage.start()
+            for stage in stages:
+                stage.join(self.remaining(SYNC_RESERVE))
+            self.progress('processes stopped', not any(stage.is_alive() for stage in stages), SYNC_RESERVE)
+
+            sync = threading.Thread(target=subprocess.call, args=(['sync'],))
+            sync.daemon = True
+            sync.start()
+            sync.join(self.remaining())
+            self.progress('filesystems synced', not sync.is_alive())
+
+        except Exception as e:  # never let a failing stage prevent the halt
+            logger.critical('shutdown stage failed: %s' % e)
+
+        logger.debug('halting after %.2f s' % (monotonic() - start))
+        if self.halt is not None:
+            self.halt()
+
+    def progress(self, stage, success, reserve=0):
+        """ Logs a completed stage and notifies the controller within the budget
+
+        :param stage: stage description
+        :param success: True if the stage completed in time
+        :param reserve: seconds to keep back for later stages
+        :return:
+        """
+        logger.debug('%s%s (%.2f s left)' % (stage, '' if success else ' (timed out)', self.remaining()))
+
+        if self.notify is None:
+            return
+
+        try:
+            self.notify(success, self.remaining(reserve + NOTIFY_RESERVE))
+        except MSCException as e:
+            logger.debug('notify failed: %s' % e)
+
+    def stop_emulators(self):
+        """ Saves the running game and stops the emulators
+
+        :return:
+        """
+        if self.save_state is not None and find_processes(['retroarch']):
+            self.save_state()
+            time.sleep(min(SAVE_STATE_WAIT, self.remaining(SYNC_RESERVE)))
+
+        self.terminate(EMULATOR_NAMES, SYNC_RESERVE)
+
+    def terminate(self, procnames, reserve):
+        """ Stops processes with SIGTERM, then SIGKILL once the budget (less the reserve) is used up
+
+        :param procnames: process names
+        :param reserve: seconds to keep back for later stages
+        :return:
+        """
+        procs = find_processes(procnames)
+        for proc in procs:
+            logger.debug('stopping... %s (pid:%d)' % (proc.name(), proc.pid))
+            subprocess.call(["sudo", "kill", "-15", str(proc.pid)])
+
+        gone, alive = psutil.wait_procs(procs, timeout=self.remaining(reserve + KILL_RESERVE))
+        for proc in alive:
+            logger.debug('killing... %s (pid:%d)' % (proc.name(), proc.pid))
+            subprocess.call(["sudo", "kill", "-9", str(proc.pid)])
+
+
+def find_processes(procnames):
+    """ Finds running processes by name
+
+    :param procnames: process names
+    :return: list of processes
+    """
+    result = []
+    for proc in psutil.process_iter():
+        try:
+            if proc.name() in procnames:
+                result.append(proc)
+        except psutil.NoSuchProcess:
+            pass
+    return result
@@ -0,0 +1,172 @@
+# !/usr/bin/env python
+
+"""
+Thermal
+------------------------------------------------------------
+CPU temperature history with trend estimation and the raspberry pi throttling flags.
+
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, TITLE AND
+NON-INFRINGEMENT. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR
+ANYONE DISTRIBUTING THE SOFTWARE BE LIABLE FOR ANY DAMAGES OR
+OTHER LIABILITY, WHETHER IN CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import array
+from clock import monotonic
+
+# sysfs files
+CPU_TEMPERATURE_PATH = '/sys/class/thermal/thermal_zone0/temp'
+THROTTLED_PATH = '/sys/devices/platform/soc/soc:firmware/get_throttled'
+
+# Number of samples kept
+HISTORY_SIZE = 120
+
+# Number of recent samples used to estimate the trend
+TREND_WINDOW = 6
+
+# Bits reported by get_throttled
+THROTTLED_FLAGS = {0 : 'under-voltage',
+                   1 : 'arm-frequency-capped',
+                   2 : 'throttled',
+                   3 : 'soft-temperature-limit',
+                   16: 'under-voltage-occurred',
+                   17: 'arm-frequency-capped-occurred',
+                   18: 'throttled-occurred',
+                   19: 'soft-temperature-limit-occurred'}
+
+
+def read_cpu_temperature(path=CPU_TEMPERATURE_PATH):
+    """ Reads the CPU temperature from sysfs
+
+    :param path: thermal zone temperature file
+    :return: temperature in degrees C; otherwise None if not available
+    """
+    try:
+        with open(path) as f:
+            return int(f.read()) / 1000.0
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def read_throttled(path=THROTTLED_PATH):
+    """ Reads the throttling flags from sysfs
+
+    :param path: get_throttled file
+    :return: list of flag names; otherwise None if not available
+    """
+    try:
+        with open(path) as f:
+            value = int(f.read(), 16)
+    except (IOError, OSError, ValueError):
+        return None
+
+    return [name for bit, name in sorted(THROTTLED_FLAGS.items()) if value & (1 << bit)]
+
+
+class ThermalHistory(object):
+    """
+        Fixed size ring of temperature samples
+    """
+
+    def __init__(self, size=HISTORY_SIZE):
+        """
+        :param size: number of samples kept
+        """
+        self.size = size
+        self.times = array.array('d', [0.0] * size)
+        self.temperatures = array.array('f', [0.0] * size)
+        self.count = 0
+        self.next = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, temperature, t=None):
+        """ Adds a sample, replacing the oldest sample when full
+
+        :param temperature: temperature in degrees C
+        :param t: monotonic time of the sample; now if None
+        :return:
+        """
+        self.times[self.next] = monotonic() if t is None else t
+        self.temperatures[self.next] = temperature
+        self.next = (self.next + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def samples(self, n=None):
+        """ Gets the most recent samples
+
+        :param n: number of samples; all if None
+        :return: list of (time, temperature), oldest first
+        """
+        if n is None or n > self.count:
+            n = self.count
+        indexes = [(self.next - n + i) % self.size for i in range(n)]
+        return [(self.times[i], self.temperatures[i]) for i in indexes]
+
+    def latest(self):
+        """ Gets the most recent temperature
+
+        :return: temperature; otherwise None if empty
+        """
+        if not self.count:
+            return None
+        return self.temperatures[(self.next - 1) % self.size]
+
+    def slope(self, window=TREND_WINDOW):
+        """ Estimates the rate of change with a least squares fit over the recent samples
+
+        :param window: number of samples used
+        :return: degrees C per second; 0 if there are not enough samples
+        """
+        samples = self.samples(window)
+        n = len(samples)
+        if n < 2:
+            return 0.0
+
+        t0 = samples[0][0]
+        mean_t = sum(t - t0 for t, _ in samples) / n
+        mean_temp = sum(temp for _, temp in samples) / n
+        numerator = sum((t - t0 - mean_t) * (temp - mean_temp) for t, temp in samples)
+        denominator = sum((t - t0 - mean_t) ** 2 for t, _ in samples)
+        if denominator == 0:
+            return 0.0
+        return numerator / denominator
+
+    def projected(self, horizon, window=TREND_WINDOW):
+        """ Projects the temperature forward along the current trend
+
+        :param horizon: seconds ahead
+        :param window: number of samples used for the trend
+        :return: projected temperature; otherwise None if empty
+        """
+        latest = self.latest()
+        if latest is None:
+            return None
+        return latest + self.slope(window) * horizon
+
+    def summary(self):
+        """ Summarises the history
+
+        :return: dictionary with samples, latest, min, max, avg, slope (degrees C/s) and throttled flags
+        """
+        temperatures = [temp for _, temp in self.samples()]
+        result = {'samples'  : len(temperatures),
+                  'latest'   : self.latest(),
+                  'min'      : None,
+                  'max'      : None,
+                  'avg'      : None,
+                  'slope'    : self.slope(),
+                  'throttled': read_throttled()}
+
+        if temperatures:
+            result['min'] = min(temperatures)
+            result['max'] = max(temperatures)
+            result['avg'] = sum(temperatures) / len(temperatures)
+
+        return result